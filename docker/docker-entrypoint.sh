@@ -9,6 +9,7 @@ done
 >&2 echo "Postgres is up - continuing"
 
 /venv/bin/python manage.py migrate --noinput
+/venv/bin/python manage.py createcachetable
 /venv/bin/python manage.py collectstatic --noinput
 
 exec "$@"
@@ -0,0 +1,13 @@
+from rest_framework.pagination import CursorPagination
+
+
+class SongCursorPagination(CursorPagination):
+    """
+    Keyset pagination on (filename, id), the cursor points to the last
+    filename seen so deep pages cost the same as the first one.
+    """
+
+    ordering = ("filename", "id")
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
@@ -0,0 +1,69 @@
+import msgpack
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+
+from nickelodeon.api.serializers import song_url_template
+
+SONG_COLUMNS = ("id", "filename", "duration", "owner")
+
+
+def song_columns(data, request):
+    """
+    Turns a list of songs, or a page of them, into one array per column.
+    The URLs differ only by the song id and are sent once as templates
+    where "{id}" is to be replaced. Anything else, errors for instance, is
+    left as is.
+    """
+    page = None
+    if isinstance(data, dict) and "results" in data:
+        page, data = data, data["results"]
+    if not isinstance(data, list):
+        return data
+    columns = {}
+    for name, field in (("url", "song_detail"), ("download_url", "song_download")):
+        prefix, suffix = song_url_template(request, field) if request else ("", "")
+        columns[f"{name}_template"] = prefix + "{id}" + suffix if prefix else ""
+    for column in SONG_COLUMNS:
+        columns[column] = [song[column] for song in data]
+    if page is not None:
+        columns = {**page, "results": columns}
+    return columns
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    Song listings as JSON columns, see song_columns.
+    """
+
+    media_type = "application/vnd.nickelodeon.columns+json"
+    format = "columns"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        request = (renderer_context or {}).get("request")
+        return super().render(
+            song_columns(data, request), accepted_media_type, renderer_context
+        )
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Song listings as MessagePack columns, see song_columns.
+    """
+
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        request = (renderer_context or {}).get("request")
+        return msgpack.packb(song_columns(data, request))
+
+
+SONG_LIST_RENDERER_CLASSES = [
+    *api_settings.DEFAULT_RENDERER_CLASSES,
+    ColumnarJSONRenderer,
+    MessagePackRenderer,
+]
@@ -1,10 +1,17 @@
 import re
 
-from rest_framework import serializers
-from rest_framework.exceptions import ValidationError
+from django.db import models
+from django.urls import reverse
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException, ValidationError
 
-from nickelodeon.models import MP3Song
-from nickelodeon.tasks import move_file
+from nickelodeon.models import MP3Song, SongMove, UploadJob
+from nickelodeon.tasks import FilenameConflict, move_songs
+
+
+class FileMovePending(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Song renamed but its file could not be moved yet"
 
 
 def validate_filename(filename):
@@ -26,6 +33,61 @@ class RelativeURLField(serializers.ReadOnlyField):
         return url
 
 
+URL_PLACEHOLDER = "PLACEHOLDER"
+
+
+def song_url_template(request, name):
+    """
+    Absolute URL of the song view name split around the song id, as a
+    (prefix, suffix) pair.
+    """
+    url = request.build_absolute_uri(reverse(name, kwargs={"pk": URL_PLACEHOLDER}))
+    prefix, suffix = url.rsplit(URL_PLACEHOLDER, 1)
+    return prefix, suffix
+
+
+class MP3SongListSerializer(serializers.ListSerializer):
+    """
+    Fast path of MP3SongSerializer(many=True) producing the same rows
+    without the field machinery. The URLs are built from templates
+    resolved once and querysets only fetch the columns needed.
+    """
+
+    def url_template(self, name):
+        request = self.context.get("request")
+        if request is None:
+            return "", ""
+        return song_url_template(request, name)
+
+    def to_representation(self, data):
+        if isinstance(data, models.manager.BaseManager):
+            data = data.all()
+        if isinstance(data, models.QuerySet):
+            rows = data.values_list("id", "filename", "duration", "owner__username")
+        else:
+            rows = (
+                (song.id, song.filename, song.duration, song.owner_username)
+                for song in data
+            )
+        url_prefix, url_suffix = self.url_template("song_detail")
+        download_prefix, download_suffix = self.url_template("song_download")
+        return [
+            {
+                "id": song_id,
+                "url": url_prefix + song_id + url_suffix if url_prefix else "",
+                "filename": filename,
+                "duration": duration,
+                "download_url": (
+                    download_prefix + song_id + download_suffix
+                    if download_prefix
+                    else ""
+                ),
+                "owner": owner,
+            }
+            for song_id, filename, duration, owner in rows
+        ]
+
+
 class MP3SongSerializer(serializers.ModelSerializer):
     url = RelativeURLField(source="get_absolute_url")
     download_url = RelativeURLField(source="get_download_url")
@@ -35,21 +97,52 @@ class MP3SongSerializer(serializers.ModelSerializer):
     duration = serializers.ReadOnlyField()
 
     def update(self, instance, validated_data):
-        if not instance.can_move_to_dest(validated_data["filename"]):
+        filename = validated_data.pop("filename", instance.filename)
+        try:
+            move_songs([(instance, filename)])
+        except FilenameConflict:
             raise ValidationError("Filename already used")
-        original_instance = MP3Song.objects.get(id=instance.id)
-        if validated_data["filename"] != original_instance.filename:
-            move_file(
-                original_instance.id,
-                original_instance.filename,
-                validated_data["filename"],
-            )
-        saved_instance = super(MP3SongSerializer, self).update(instance, validated_data)
-        return saved_instance
+        if SongMove.objects.filter(song=instance).exists():
+            # Renamed, the file is moved once the upload worker retries
+            raise FileMovePending()
+        return super(MP3SongSerializer, self).update(instance, validated_data)
 
     class Meta:
         model = MP3Song
         fields = ("id", "url", "filename", "duration", "download_url", "owner")
+        list_serializer_class = MP3SongListSerializer
+
+
+class SongBulkDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.CharField(max_length=12),
+        max_length=5000,
+        required=False,
+    )
+    folder = serializers.CharField(required=False, validators=[validate_filename])
+
+    def validate(self, data):
+        if ("ids" in data) == ("folder" in data):
+            raise ValidationError("Either ids or folder is required")
+        if "folder" in data:
+            data["folder"] = data["folder"].rstrip("/") + "/"
+        return data
+
+
+class SongLookupSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.CharField(max_length=12),
+        max_length=1000,
+    )
+
+
+class UploadJobSerializer(serializers.ModelSerializer):
+    song = MP3SongSerializer(read_only=True)
+
+    class Meta:
+        model = UploadJob
+        fields = ("id", "filename", "status", "error", "song", "duplicate")
+        read_only_fields = fields
 
 
 class ChangePasswordSerializer(serializers.Serializer):
@@ -1,15 +1,61 @@
 import base64
+import datetime
+import gzip
+import json
 import tempfile
-from io import BytesIO
+import time
+from io import BytesIO, StringIO
+from unittest import mock
 
+import msgpack
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 
-from nickelodeon.models import MP3Song
-from nickelodeon.utils import s3_create_bucket, s3_object_exists, s3_upload
+from nickelodeon.api.serializers import MP3SongSerializer
+from nickelodeon.models import (
+    BackfillCheckpoint,
+    MP3Song,
+    MP3SongSequence,
+    SongMove,
+    UploadJob,
+    UploadSession,
+    UserSettings,
+)
+from nickelodeon.tasks import (
+    FilenameConflict,
+    get_taken_filenames,
+    move_folder,
+    move_songs,
+    reserve_song,
+    roll_forward_moves,
+    store_song,
+)
+from nickelodeon.utils import (
+    file_content_hash,
+    get_s3_client,
+    get_s3_presigner,
+    in_shard,
+    random_key,
+    s3_create_bucket,
+    s3_delete_objects,
+    s3_get_file,
+    s3_metadata_cache_stats,
+    s3_move_object,
+    s3_object_delete,
+    s3_object_exists,
+    s3_object_metadata,
+    s3_upload,
+)
 
 PATH_TEMP = tempfile.mkdtemp()
 
@@ -161,6 +207,22 @@ class ApiTestCase(APITestCase):
                 f"/s3/{settings.S3_BUCKET}/{self.user.settings.storage_prefix}/bar.mp3"
             )
         )
+        # A file that could not be moved is reported and moved by the worker
+        with mock.patch(
+            "nickelodeon.tasks.s3_copy_object", side_effect=Exception("Slow down")
+        ):
+            res = self.client.put(song_url, data={"filename": "baz"})
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        SongMove.objects.update(
+            modification_date=timezone.now() - datetime.timedelta(hours=1)
+        )
+        call_command("process_uploads", once=True, stdout=StringIO())
+        self.assertFalse(SongMove.objects.exists())
+        self.assertTrue(
+            s3_object_exists(f"{self.user.settings.storage_prefix}/baz.mp3")
+        )
+        res = self.client.put(song_url, data={"filename": "bar"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
         res = self.client.delete(song_url)
         self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
         res = self.client.get(random_song_url)
@@ -184,3 +246,577 @@ class ApiTestCase(APITestCase):
         logout_url = reverse("knox_logout")
         res = self.client.post(logout_url)
         self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_search(self):
+        MP3Song.objects.create(owner=self.user, filename="Beyoncé/Crazy in Love")
+        MP3Song.objects.create(owner=self.user, filename="Daft Punk/One More Time")
+        self.client.login(username=self.username, password=self.password)
+        search_url = reverse("song_list")
+        res = self.client.get(search_url, data={"q": "beyonce crazy"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [song["filename"] for song in res.data], ["Beyoncé/Crazy in Love"]
+        )
+        res = self.client.get(search_url, data={"q": '"more time" DAFT'})
+        self.assertEqual(
+            [song["filename"] for song in res.data], ["Daft Punk/One More Time"]
+        )
+        res = self.client.get(search_url, data={"q": '"time one"'})
+        self.assertEqual(len(res.data), 0)
+
+    def test_search_pagination(self):
+        for i in range(5):
+            MP3Song.objects.create(owner=self.user, filename=f"foo/{i}")
+        self.client.login(username=self.username, password=self.password)
+        res = self.client.get(reverse("song_list"), data={"q": "foo", "page_size": 2})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIsNone(res.data["previous"])
+        filenames = []
+        while True:
+            self.assertLessEqual(len(res.data["results"]), 2)
+            filenames += [song["filename"] for song in res.data["results"]]
+            if not res.data["next"]:
+                break
+            res = self.client.get(res.data["next"])
+        self.assertEqual(
+            filenames, ["foo", "foo/0", "foo/1", "foo/2", "foo/3", "foo/4"]
+        )
+
+    def test_random_song_sequence(self):
+        songs = [
+            MP3Song.objects.create(owner=self.user, filename=f"bar/{i}")
+            for i in range(4)
+        ]
+        songs[1].delete()
+        MP3Song.objects.filter(id__in=[songs[0].id, songs[3].id]).delete()
+        self.assertEqual(sorted(MP3Song.objects.values_list("seq", flat=True)), [1, 2])
+        self.client.login(username=self.username, password=self.password)
+        found = set()
+        for _ in range(20):
+            res = self.client.get(reverse("song_random"))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            found.add(res.data["id"])
+        self.assertEqual(found, {self.song.id, songs[2].id})
+        MP3Song.objects.bulk_create(
+            MP3Song(owner=self.user, filename=f"baz/{i}") for i in range(400)
+        )
+        # Holes are filled with one query per batch, whatever their number
+        with CaptureQueriesContext(connection) as queries:
+            MP3Song.objects.filter(filename__regex=r"^baz/[0-9]*[02468]$").delete()
+        seq_updates = [
+            q for q in queries if q["sql"].startswith('UPDATE "nickelodeon_mp3song"')
+        ]
+        self.assertEqual(len(seq_updates), 1)
+        # Songs deleted along with their owner leave no hole
+        bob = User.objects.create_user("bob")
+        MP3Song.objects.bulk_create(
+            MP3Song(owner=bob, filename=f"bob/{i}") for i in range(10)
+        )
+        MP3Song.objects.filter(filename="baz/1").delete()
+        bob.delete()
+        self.assertEqual(
+            sorted(MP3Song.objects.values_list("seq", flat=True)), list(range(1, 202))
+        )
+        self.assertEqual(MP3SongSequence.objects.get().count, 201)
+
+    def test_random_song_list(self):
+        MP3Song.objects.bulk_create(
+            MP3Song(owner=self.user, filename=f"baz/{i}") for i in range(120)
+        )
+        self.client.login(username=self.username, password=self.password)
+        url = reverse("song_random_list")
+        # Songs are sampled until the new deck is built
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len({song["id"] for song in res.data}), 100)
+        out = StringIO()
+        # The upload worker builds it while its queue is empty
+        call_command("process_uploads", once=True, stdout=out)
+        self.assertIn("Built 1 shuffle deck(s)", out.getvalue())
+        self.assertEqual(self.user.shuffle_deck.cards.count(), 121)
+        res = self.client.get(url)
+        first_hand = [song["id"] for song in res.data]
+        self.assertEqual(len(set(first_hand)), 100)
+        for i in range(5):
+            MP3Song.objects.create(owner=self.user, filename=f"qux/{i}")
+        res = self.client.get(url)
+        second_hand = [song["id"] for song in res.data]
+        self.assertEqual(len(set(second_hand)), 100)
+        self.assertEqual(
+            set(first_hand) | set(second_hand[:26]),
+            set(MP3Song.objects.values_list("id", flat=True)),
+        )
+
+    def test_storage_prefix_cache(self):
+        song = MP3Song.objects.get(id=self.song.id)
+        path = song.get_file_format_path()
+        with self.assertNumQueries(0):
+            self.assertEqual(song.get_file_format_path(), path)
+        user_settings = self.user.settings
+        user_settings.storage_prefix = "alice-new"
+        user_settings.save()
+        self.assertEqual(song.get_file_format_path(), "alice-new/foo.mp3")
+        # Changes made by other processes show up once the entry expires
+        UserSettings.objects.filter(user=self.user).update(storage_prefix="alice")
+        self.assertEqual(song.get_file_format_path(), "alice-new/foo.mp3")
+        later = time.monotonic() + settings.STORAGE_PREFIX_CACHE_TIMEOUT
+        with mock.patch("nickelodeon.models.time.monotonic", return_value=later):
+            self.assertEqual(song.get_file_format_path(), path)
+
+    def test_presigned_urls_match_boto3(self):
+        now = datetime.datetime(2024, 2, 29, 23, 59, 59, tzinfo=datetime.timezone.utc)
+        for method in ("GET", "HEAD"):
+            for key in ("alice/foo.mp3", "alice/É ü+&=%~ (1)!*'.mp3"):
+                with mock.patch("botocore.auth.get_current_datetime", return_value=now):
+                    expected = get_s3_client().generate_presigned_url(
+                        ClientMethod=f"{method.lower()}_object",
+                        Params={
+                            "Bucket": settings.S3_BUCKET,
+                            "Key": key,
+                        },
+                    )
+                self.assertEqual(get_s3_presigner().url(method, key, now=now), expected)
+
+    def test_s3_metadata_cache(self):
+        cache.clear()
+        s3_metadata_cache_stats.clear()
+        prefix = self.user.settings.storage_prefix
+        self.assertEqual(s3_object_metadata(f"{prefix}/foo.mp3")["size"], 72)
+        self.assertTrue(s3_object_exists(f"{prefix}/foo.mp3"))
+        self.assertFalse(s3_object_exists(f"{prefix}/bar.mp3"))
+        self.assertFalse(s3_object_exists(f"{prefix}/bar.mp3"))
+        self.assertEqual(s3_metadata_cache_stats, {"hits": 2, "misses": 2})
+        s3_move_object(f"{prefix}/foo.mp3", f"{prefix}/bar.mp3")
+        self.assertFalse(s3_object_exists(f"{prefix}/foo.mp3"))
+        self.assertTrue(s3_object_exists(f"{prefix}/bar.mp3"))
+        self.assertEqual(s3_metadata_cache_stats, {"hits": 3, "misses": 3})
+        s3_object_delete(f"{prefix}/bar.mp3")
+
+    def test_song_file_metadata(self):
+        self.assertTrue(self.song.has_mp3)
+        song = MP3Song.objects.get(id=self.song.id)
+        self.assertEqual((song.mp3_available, song.size), (True, 72))
+        self.assertTrue(song.etag)
+        s3_metadata_cache_stats.clear()
+        song.remove_files()
+        self.assertEqual(s3_metadata_cache_stats, {})
+        self.assertFalse(
+            s3_object_exists(f"{self.user.settings.storage_prefix}/foo.mp3")
+        )
+
+    def test_store_song_collisions(self):
+        prefix = self.user.storage_prefix
+        s3_upload(BytesIO(b"data"), f"{prefix}/foo (1).mp3")
+        with mock.patch(
+            "nickelodeon.tasks.get_available_filename",
+            side_effect=["foo (1)", "foo (2)"],
+        ):
+            # A name reserved concurrently is skipped
+            MP3Song.objects.create(owner=self.user, filename="foo (1)")
+            song = reserve_song(self.user, prefix, "foo")
+        self.assertEqual(song.filename, "foo (2)")
+        # Not listed before its file is stored
+        self.client.login(username=self.username, password=self.password)
+        res = self.client.get(reverse("song_list"), data={"q": "foo"})
+        self.assertNotIn(song.id, [row["id"] for row in res.data])
+        self.assertEqual(
+            get_taken_filenames(self.user, prefix, "foo"),
+            {f"{prefix}/foo", f"{prefix}/foo (1)", f"{prefix}/foo (2)"},
+        )
+        song = store_song(
+            self.user, prefix, "foo", lambda key: s3_upload(BytesIO(b"new"), key)
+        )
+        self.assertEqual(song.filename, "foo (3)")
+        self.assertTrue(song.mp3_available)
+        for filename in ("foo (1)", "foo (3)"):
+            s3_object_delete(f"{prefix}/{filename}.mp3")
+
+    def test_refresh_song_db(self):
+        folder = f"{self.user.storage_prefix}/Library"
+        keys = [
+            f"{folder}/Rock/a.mp3",
+            f"{folder}/Rock/b.mp3",
+            f"{folder}/Pop/c.mp3",
+            # Sorted before Rock/a.mp3 by the bucket, after Rock/a by name
+            f"{folder}/Rock/a (live).mp3",
+        ]
+        for key in keys:
+            s3_upload(BytesIO(b"data"), key)
+        MP3Song.objects.create(owner=self.user, filename="Library/Jazz/gone")
+
+        def refresh(*args):
+            out = StringIO()
+            call_command("refresh_song_db", folder, *args, stdout=out)
+            songs = MP3Song.objects.filter(
+                owner=self.user, filename__startswith="Library/"
+            ).values_list("filename", flat=True)
+            return {filename[len("Library/") :] for filename in songs}, out.getvalue()
+
+        songs, out = refresh()
+        self.assertEqual(songs, {"Rock/a", "Rock/a (live)", "Rock/b", "Pop/c"})
+        songs, out = refresh("--full")
+        self.assertIn("Discovered 0 new file(s)\nRemoved 0 file(s)", out)
+        # Songs already in the library are skipped, keeping the seqs dense
+        self.assertEqual(
+            MP3Song.objects.bulk_create(
+                [MP3Song(owner=self.user, filename="Library/Pop/c")],
+                ignore_conflicts=True,
+            ),
+            [],
+        )
+        self.assertEqual(
+            sorted(MP3Song.objects.values_list("seq", flat=True)),
+            list(range(1, MP3Song.objects.count() + 1)),
+        )
+        # Unchanged prefixes are not compared with the database
+        MP3Song.objects.create(owner=self.user, filename="Library/Rock/ghost")
+        songs, out = refresh()
+        self.assertIn("Compared 0 music file(s)", out)
+        self.assertIn("Rock/ghost", songs)
+        s3_object_delete(keys[0])
+        s3_object_delete(keys[2])
+        songs, out = refresh()
+        self.assertEqual(songs, {"Rock/a (live)", "Rock/b"})
+        # Songs reserved by an upload or being moved are left alone, as well
+        # as the files being moved
+        reserve_song(self.user, folder, "Reserved")
+        with mock.patch(
+            "nickelodeon.tasks.s3_copy_object", side_effect=Exception("Slow down")
+        ):
+            move_songs([(MP3Song.objects.get(filename="Library/Rock/b"), "Library/b")])
+        songs, out = refresh("--full")
+        self.assertEqual(songs, {"Rock/a (live)", "b", "Reserved"})
+        self.assertIn("Discovered 0 new file(s)\nRemoved 0 file(s)", out)
+        roll_forward_moves(older_than=0)
+        s3_object_delete(f"{folder}/b.mp3")
+        s3_object_delete(keys[3])
+
+    def test_move_songs(self):
+        prefix = self.user.storage_prefix
+        for filename in ("Old/a", "Old/b"):
+            s3_upload(BytesIO(filename.encode()), f"{prefix}/{filename}.mp3")
+            MP3Song.objects.create(owner=self.user, filename=filename)
+        with self.assertRaises(FilenameConflict):
+            move_songs([(MP3Song.objects.get(filename="Old/a"), "foo")])
+        songs = move_folder(self.user, "Old/", "New/")
+        self.assertEqual(sorted(song.filename for song in songs), ["New/a", "New/b"])
+        self.assertEqual(MP3Song.objects.filter(filename__startswith="New/").count(), 2)
+        self.assertFalse(s3_object_exists(f"{prefix}/Old/a.mp3"))
+        self.assertEqual(s3_get_file(f"{prefix}/New/a.mp3").getvalue(), b"Old/a")
+        # A name taken after the check is not overwritten
+        s3_upload(BytesIO(b"other"), f"{prefix}/Taken.mp3")
+        MP3Song.objects.create(owner=self.user, filename="Taken")
+        song = MP3Song.objects.get(filename="New/a")
+        with (
+            mock.patch("nickelodeon.tasks.find_conflicts", side_effect=[[], ["Taken"]]),
+            self.assertRaises(FilenameConflict),
+        ):
+            move_songs([(song, "Taken")])
+        self.assertEqual(song.filename, "New/a")
+        self.assertEqual(s3_get_file(f"{prefix}/Taken.mp3").getvalue(), b"other")
+        self.assertFalse(SongMove.objects.exists())
+        # A failed copy is left to be rolled forward
+        song = MP3Song.objects.get(filename="New/b")
+        with mock.patch(
+            "nickelodeon.tasks.s3_copy_object", side_effect=Exception("Slow down")
+        ):
+            move_songs([(song, "Moved/b")])
+        self.assertEqual(MP3Song.objects.get(id=song.id).filename, "Moved/b")
+        self.assertEqual(SongMove.objects.get().error, "Slow down")
+        # Moves are only rolled forward once their lease expired
+        self.assertEqual(roll_forward_moves(), [])
+        self.assertEqual(roll_forward_moves(older_than=0), [song])
+        self.assertFalse(s3_object_exists(f"{prefix}/New/b.mp3"))
+        self.assertEqual(s3_get_file(f"{prefix}/Moved/b.mp3").getvalue(), b"Old/b")
+        self.assertFalse(SongMove.objects.exists())
+        s3_delete_objects(
+            [f"{prefix}/New/a.mp3", f"{prefix}/Moved/b.mp3", f"{prefix}/Taken.mp3"]
+        )
+
+    def test_bulk_delete(self):
+        prefix = self.user.storage_prefix
+        songs = []
+        for filename in ("Album/a", "Album/b", "Album/c", "Other/d"):
+            s3_upload(BytesIO(b"data"), f"{prefix}/{filename}.mp3")
+            songs.append(MP3Song.objects.create(owner=self.user, filename=filename))
+        bob = User.objects.create_user("bob", "bob@aol.com", "passw0rd!")
+        bob_song = MP3Song.objects.create(owner=bob, filename="Album/a")
+        url = reverse("song_bulk_delete")
+        self.client.login(username=self.username, password=self.password)
+        res = self.client.post(url, {"folder": ""}, format="json")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.post(url, {"ids": [songs[0].id, bob_song.id]}, format="json")
+        self.assertEqual(res.data["deleted"], [songs[0].id])
+        self.assertEqual(
+            res.data["failed"], [{"id": bob_song.id, "error": "Not found"}]
+        )
+        res = self.client.post(url, {"folder": "Album"}, format="json")
+        self.assertEqual(
+            sorted(res.data["deleted"]), sorted([songs[1].id, songs[2].id])
+        )
+        self.assertEqual(
+            list(
+                MP3Song.objects.filter(owner=self.user)
+                .values_list("filename", flat=True)
+                .order_by("filename")
+            ),
+            ["Other/d", "foo"],
+        )
+        self.assertTrue(MP3Song.objects.filter(id=bob_song.id).exists())
+        self.assertFalse(s3_object_exists(f"{prefix}/Album/b.mp3"))
+        songs[3].remove_files()
+
+    def test_song_lookup(self):
+        bar = MP3Song.objects.create(owner=self.user, filename="bar")
+        url = reverse("song_lookup")
+        res = self.client.post(url, {"ids": [bar.id]}, format="json")
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.login(username=self.username, password=self.password)
+        with self.assertNumQueries(3):
+            # Session, user and songs
+            res = self.client.post(
+                url, {"ids": [bar.id, "missing", self.song.id, bar.id]}, format="json"
+            )
+        self.assertEqual(
+            [song["id"] for song in res.data["results"]], [bar.id, self.song.id]
+        )
+        self.assertEqual(res.data["results"][0]["owner"], self.username)
+        self.assertEqual(res.data["missing"], ["missing"])
+
+    def test_song_list_serializer(self):
+        MP3Song.objects.create(owner=self.user, filename="bar", duration=42)
+        request = APIRequestFactory().get("/")
+        songs = MP3Song.objects.select_related("owner").order_by("filename")
+        for context in ({"request": request}, {}):
+            expected = [MP3SongSerializer(song, context=context).data for song in songs]
+            self.assertEqual(
+                MP3SongSerializer(songs, many=True, context=context).data, expected
+            )
+            self.assertEqual(
+                MP3SongSerializer(list(songs), many=True, context=context).data,
+                expected,
+            )
+
+    def test_song_list_formats(self):
+        self.client.login(username=self.username, password=self.password)
+        search_url = reverse("song_list")
+        cache.clear()
+        res = self.client.get(search_url, data={"q": "foo"})
+        rows = res.json()
+        res = self.client.get(
+            search_url,
+            data={"q": "foo"},
+            HTTP_ACCEPT="application/vnd.nickelodeon.columns+json",
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        columns = res.json()
+        self.assertEqual(columns["id"], [self.song.id])
+        self.assertEqual(columns["filename"], ["foo"])
+        self.assertEqual(columns["owner"], [self.username])
+        self.assertEqual(
+            columns["url_template"].replace("{id}", self.song.id), rows[0]["url"]
+        )
+        self.assertEqual(
+            columns["download_url_template"].replace("{id}", self.song.id),
+            rows[0]["download_url"],
+        )
+        res = self.client.get(
+            search_url, data={"q": "foo", "page_size": 10, "format": "columns"}
+        )
+        self.assertIsNone(res.json()["next"])
+        self.assertEqual(res.json()["results"]["id"], [self.song.id])
+        res = self.client.get(reverse("song_random_list"), data={"format": "columns"})
+        self.assertEqual(res.json()["id"], [self.song.id])
+        res = self.client.get(search_url, data={"q": "foo", "format": "msgpack"})
+        self.assertEqual(res["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(res.content), columns)
+        # Compressed bodies are cached by parameters and format, until songs
+        # are written
+        for cached in (False, True):
+            with CaptureQueriesContext(connection) as queries:
+                res = self.client.get(
+                    search_url,
+                    data={"q": "foo", "format": "columns"},
+                    HTTP_ACCEPT_ENCODING="gzip",
+                )
+            self.assertEqual(res["Content-Encoding"], "gzip")
+            self.assertEqual(json.loads(gzip.decompress(res.content)), columns)
+            self.assertEqual(
+                any("nickelodeon_mp3song" in q["sql"] for q in queries), not cached
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            MP3Song.objects.filter(id=self.song.id).update(duration=42)
+        res = self.client.get(
+            search_url,
+            data={"q": "foo", "format": "columns"},
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(json.loads(gzip.decompress(res.content))["duration"], [42])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.song.delete()
+        res = self.client.get(
+            search_url,
+            data={"q": "foo", "format": "columns"},
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(json.loads(gzip.decompress(res.content))["id"], [])
+
+    def test_shards(self):
+        song_ids = [random_key() for _ in range(100)]
+        shards = [
+            [song_id for song_id in song_ids if in_shard(song_id, (index, 3))]
+            for index in (1, 2, 3)
+        ]
+        self.assertTrue(all(shards))
+        self.assertEqual(sorted(sum(shards, [])), sorted(song_ids))
+        out = StringIO()
+        for shard in ("1/2", "2/2"):
+            call_command("add_durations", "--shard", shard, stdout=out, stderr=out)
+        # The song of the setUp is processed by exactly one of the shards
+        self.assertEqual(out.getvalue().count(" songs updated, "), 1)
+        with self.assertRaises(CommandError):
+            call_command("add_durations", "--shard", "3/2")
+
+    def test_duration_from_headers(self):
+        # 40 seconds of silent 128kbps 44.1kHz CBR frames, without Xing header
+        frame = b"\xff\xfb\x90\x00" + bytes(413)
+        data = frame * round(40 * 44100 / 1152)
+        s3_upload(BytesIO(data), f"{self.user.settings.storage_prefix}/cbr.mp3")
+        song = MP3Song.objects.create(owner=self.user, filename="cbr")
+        duration, bytes_transferred = song.probe_duration()
+        self.assertEqual(duration, 40)
+        self.assertLess(bytes_transferred, len(data) / 2)
+        self.assertEqual(song.get_duration(), 40)
+        self.assertEqual(MP3Song.objects.get(id=song.id).duration, 40)
+        song.remove_files()
+
+    def test_backfill_durations(self):
+        frame = b"\xff\xfb\x90\x00" + bytes(413)
+        s3_upload(BytesIO(frame * 1000), f"{self.user.storage_prefix}/cbr.mp3")
+        song = MP3Song.objects.create(owner=self.user, filename="cbr")
+        MP3Song.objects.create(owner=self.user, filename="missing")
+        # Resumes after the checkpoint of an interrupted run
+        BackfillCheckpoint.objects.create(name="duration", last_id=song.id)
+        call_command("add_durations", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(MP3Song.objects.get(id=song.id).duration, 0)
+        out = StringIO()
+        call_command("add_durations", "--restart", "-w", "4", stdout=out, stderr=out)
+        self.assertEqual(MP3Song.objects.get(id=song.id).duration, 26)
+        self.assertIn("1 errors", out.getvalue())
+        self.assertFalse(BackfillCheckpoint.objects.exists())
+        song.remove_files()
+
+    def upload_mp3(self, filename, data, chunk_size=1024 * 1024, reverse_order=False):
+        total_chunks = max(len(data) // chunk_size, 1)
+        numbers = range(1, total_chunks + 1)
+        for number in reversed(numbers) if reverse_order else numbers:
+            start = (number - 1) * chunk_size
+            end = start + chunk_size if number < total_chunks else len(data)
+            res = self.client.post(
+                reverse("mp3-upload"),
+                data={
+                    "resumableChunkNumber": number,
+                    "resumableChunkSize": chunk_size,
+                    "resumableCurrentChunkSize": end - start,
+                    "resumableTotalSize": len(data),
+                    "resumableTotalChunks": total_chunks,
+                    "resumableIdentifier": f"{len(data)}-{filename}",
+                    "resumableFilename": filename,
+                    "file": SimpleUploadedFile("blob", data[start:end]),
+                },
+            )
+            if res.status_code != status.HTTP_200_OK:
+                break
+        return res
+
+    def test_upload_validation(self):
+        self.client.login(username=self.username, password=self.password)
+        res = self.upload_mp3("page.mp3", b"<html>" + bytes(3 * 1024 * 1024))
+        self.assertEqual(res.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertFalse(UploadSession.objects.exists())
+        frame = b"\xff\xfb\x90\x00" + bytes(413)
+        with override_settings(UPLOAD_MAX_SIZE=1024 * 1024):
+            res = self.upload_mp3("long.mp3", frame * 3000)
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_multipart_upload(self):
+        self.client.login(username=self.username, password=self.password)
+        # 6.5MB of 128kbps CBR frames, two parts of 5 and 1.5 chunks
+        frame = b"\xff\xfb\x90\x00" + bytes(413)
+        data = frame * (13 * 1024 * 1024 // 2 // len(frame))
+        # Chunks can arrive in any order, a complete file is queued once
+        res = self.upload_mp3("upload.mp3", data, reverse_order=True)
+        self.assertEqual(res.data["status"], "pending")
+        self.assertEqual(self.upload_mp3("upload.mp3", data).data["id"], res.data["id"])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UploadJob.objects.create(
+                owner=self.user, filename="upload.mp3", total_size=len(data)
+            )
+        job_url = reverse("upload_job_detail", kwargs={"pk": res.data["id"]})
+        with mock.patch("nickelodeon.tasks.s3_object_content_hash") as read_back:
+            call_command("process_uploads", "--once", stdout=StringIO())
+        read_back.assert_not_called()
+        res = self.client.get(job_url)
+        self.assertEqual(res.data["status"], "done")
+        song = MP3Song.objects.get(id=res.data["song"]["id"])
+        self.assertTrue(song.filename.startswith("Assorted/by_date/"))
+        self.assertEqual(song.size, len(data))
+        self.assertEqual(song.duration, round(len(data) * 8 / 128000))
+        self.assertEqual(
+            s3_object_metadata(song.get_file_format_path())["size"], len(data)
+        )
+        self.assertFalse(UploadSession.objects.exists())
+        # Hashed from the parts, as a file of the library is by the backfill
+        self.assertEqual(song.content_hash, file_content_hash(BytesIO(data)))
+        MP3Song.objects.filter(id=song.id).update(content_hash="")
+        call_command("add_content_hashes", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(
+            MP3Song.objects.get(id=song.id).content_hash, song.content_hash
+        )
+        song.remove_files()
+
+    def test_multipart_upload_retry(self):
+        self.client.login(username=self.username, password=self.password)
+        frame = b"\xff\xfb\x92\x00" + bytes(413)
+        data = frame * (13 * 1024 * 1024 // 2 // len(frame))
+        with mock.patch(
+            "nickelodeon.api.uploads.s3_upload_part",
+            side_effect=Exception("Slow down"),
+        ):
+            res = self.upload_mp3("flaky.mp3", data)
+        # The failed part is reported so that its chunk is sent again
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(UploadJob.objects.exists())
+        res = self.upload_mp3("flaky.mp3", data)
+        self.assertEqual(res.data["status"], "pending")
+        self.assertEqual(len(UploadSession.objects.get().parts), 2)
+        call_command("process_uploads", "--once", stdout=StringIO())
+        song = UploadJob.objects.get().song
+        self.assertEqual(song.size, len(data))
+        song.remove_files()
+
+    @override_settings(S3_MULTIPART_UPLOADS=False)
+    def test_upload(self):
+        self.client.login(username=self.username, password=self.password)
+        frame = b"\xff\xfb\x90\x00" + bytes(413)
+        res = self.upload_mp3("local.mp3", frame * 1000)
+        call_command("process_uploads", "--once", stdout=StringIO())
+        job_url = reverse("upload_job_detail", kwargs={"pk": res.data["id"]})
+        res = self.client.get(job_url)
+        self.assertEqual(res.data["status"], "done")
+        self.assertEqual(res.data["song"]["duration"], 26)
+        self.assertFalse(res.data["duplicate"])
+        song_id = res.data["song"]["id"]
+        song = MP3Song.objects.get(id=song_id)
+        self.assertEqual(
+            song.etag, s3_object_metadata(song.get_file_format_path())["etag"]
+        )
+        res = self.upload_mp3("copy.mp3", frame * 1000)
+        call_command("process_uploads", "--once", stdout=StringIO())
+        res = self.client.get(
+            reverse("upload_job_detail", kwargs={"pk": res.data["id"]})
+        )
+        self.assertTrue(res.data["duplicate"])
+        self.assertEqual(res.data["song"]["id"], song_id)
+        self.assertFalse(MP3Song.objects.filter(filename__endswith="copy").exists())
+        MP3Song.objects.get(id=song_id).remove_files()
@@ -0,0 +1,172 @@
+import math
+
+from django.conf import settings
+from django.db import transaction
+from resumable.files import ResumableFile
+
+from nickelodeon.models import UploadSession
+from nickelodeon.utils import (
+    CONTENT_HASH_BLOCK_SIZE,
+    block_digests,
+    random_key,
+    s3_abort_multipart_upload,
+    s3_create_multipart_upload,
+    s3_upload_part,
+)
+
+
+class PartUploadError(Exception):
+    """
+    A part could not be uploaded, its chunks are kept so that it is tried
+    again when one of them is sent again.
+    """
+
+
+class MultipartResumableFile(ResumableFile):
+    """
+    Resumable upload streamed to an S3 multipart upload. Consecutive chunks
+    are grouped in parts of at least settings.S3_MULTIPART_PART_SIZE bytes,
+    the minimum S3 accepts, and a part is uploaded as soon as all its chunks
+    are received. Only the chunks of the parts not yet uploaded are kept on
+    disk.
+    """
+
+    def __init__(self, storage, kwargs, owner):
+        super().__init__(storage, kwargs)
+        self.owner = owner
+        self.chunk_size = int(kwargs.get("resumableChunkSize"))
+        self.total_size = int(kwargs.get("resumableTotalSize"))
+        self.total_chunks = int(kwargs.get("resumableTotalChunks"))
+        part_size = getattr(settings, "S3_MULTIPART_PART_SIZE", 5 * 1024 * 1024)
+        self.chunks_per_part = max(1, math.ceil(part_size / self.chunk_size))
+        self.part_count = math.ceil(self.total_chunks / self.chunks_per_part)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = UploadSession.objects.filter(
+                owner=self.owner, identifier=self.filename
+            ).first()
+        return self._session
+
+    def get_or_create_session(self):
+        if self.session is None:
+            key = "{}/.uploads/{}.part".format(self.owner.storage_prefix, random_key())
+            self._session = UploadSession.objects.get_or_create(
+                owner=self.owner,
+                identifier=self.filename,
+                defaults={"key": key},
+            )[0]
+        if not self._session.upload_id:
+            with transaction.atomic():
+                session = self.lock_session()
+                if not session.upload_id:
+                    session.upload_id = s3_create_multipart_upload(session.key)
+                    session.save(update_fields=["upload_id"])
+        return self._session
+
+    def lock_session(self):
+        """
+        Reloads the session and locks it until the end of the transaction,
+        chunks of the same upload are received by concurrent requests.
+        """
+        self._session = UploadSession.objects.select_for_update().get(
+            pk=self.session.pk
+        )
+        return self._session
+
+    @property
+    def chunk_number(self):
+        return int(self.kwargs.get("resumableChunkNumber"))
+
+    def chunk_name(self, chunk_number):
+        return "%s%s%s" % (self.filename, self.chunk_suffix, str(chunk_number).zfill(4))
+
+    def chunk_expected_size(self, chunk_number):
+        if chunk_number < self.total_chunks:
+            return self.chunk_size
+        return self.total_size - (self.total_chunks - 1) * self.chunk_size
+
+    def chunk_is_stored(self, chunk_number):
+        name = self.chunk_name(chunk_number)
+        return self.storage.exists(name) and self.storage.size(
+            name
+        ) == self.chunk_expected_size(chunk_number)
+
+    def part_number(self, chunk_number):
+        return (chunk_number - 1) // self.chunks_per_part + 1
+
+    def part_chunks(self, part_number):
+        first = (part_number - 1) * self.chunks_per_part + 1
+        return range(first, min(first + self.chunks_per_part, self.total_chunks + 1))
+
+    def part_is_uploaded(self, part_number):
+        return self.session is not None and str(part_number) in self.session.parts
+
+    @property
+    def chunk_exists(self):
+        """
+        A chunk stored on disk is reported missing when its part is complete
+        but was not uploaded, so that sending it again uploads the part.
+        """
+        part_number = self.part_number(self.chunk_number)
+        if self.part_is_uploaded(part_number):
+            return True
+        return super().chunk_exists and not all(
+            self.chunk_is_stored(n) for n in self.part_chunks(part_number)
+        )
+
+    @property
+    def is_complete(self):
+        return self.session is not None and len(self.session.parts) == self.part_count
+
+    def process_chunk(self, file):
+        part_number = self.part_number(self.chunk_number)
+        if self.part_is_uploaded(part_number):
+            return
+        super().process_chunk(file)
+        if all(self.chunk_is_stored(n) for n in self.part_chunks(part_number)):
+            self.upload_part(part_number)
+
+    def upload_part(self, part_number):
+        """
+        Uploads a part then records it with the session locked, so that the
+        last request recording a part sees the upload complete. The lock is
+        not held during the upload: a part uploaded twice by concurrent
+        requests has the same content and ETag both times.
+        """
+        chunk_names = [self.chunk_name(n) for n in self.part_chunks(part_number)]
+        try:
+            session = self.get_or_create_session()
+            body = b"".join(self.storage.open(name).read() for name in chunk_names)
+            etag = s3_upload_part(session.key, session.upload_id, part_number, body)
+            # The file is hashed from its parts, when they are made of whole
+            # blocks
+            aligned = (
+                part_number == self.part_count
+                or len(body) % CONTENT_HASH_BLOCK_SIZE == 0
+            )
+            part = {"etag": etag, "digests": block_digests(body) if aligned else None}
+            with transaction.atomic():
+                session = self.lock_session()
+                if not self.part_is_uploaded(part_number):
+                    session.parts[str(part_number)] = part
+                    session.save(update_fields=["parts"])
+        except Exception as e:
+            raise PartUploadError(f"Upload of part {part_number} failed: {e}") from e
+        for name in chunk_names:
+            if self.storage.exists(name):
+                self.storage.delete(name)
+
+    def delete_chunks(self):
+        """
+        Deletes the chunks kept on disk and aborts the multipart upload.
+        """
+        super().delete_chunks()
+        if self.session is None:
+            return
+        if self.session.upload_id:
+            s3_abort_multipart_upload(self.session.key, self.session.upload_id)
+        self.session.delete()
+        self._session = None
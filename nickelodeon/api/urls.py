@@ -24,6 +24,16 @@ urlpatterns = [
         view=views.RandomSongListView.as_view(),
         name="song_random_list",
     ),
+    re_path(
+        r"^songs/delete/?$",
+        view=views.SongBulkDeleteView.as_view(),
+        name="song_bulk_delete",
+    ),
+    re_path(
+        r"^songs/lookup/?$",
+        view=views.SongLookupView.as_view(),
+        name="song_lookup",
+    ),
     re_path(
         r"^songs/(?P<pk>[a-zA-Z0-9_-]{11})/?$",
         view=views.SongView.as_view(),
@@ -40,4 +50,9 @@ urlpatterns = [
         name="song_download_w_ext",
     ),
     re_path(r"^mp3-upload/?", views.ResumableUploadView.as_view(), name="mp3-upload"),
+    re_path(
+        r"^upload-jobs/(?P<pk>\d+)/?$",
+        view=views.UploadJobView.as_view(),
+        name="upload_job_detail",
+    ),
 ]
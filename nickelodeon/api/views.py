@@ -1,17 +1,17 @@
-import datetime
-import os.path
-import re
+import gzip
+import hashlib
 import urllib
-from random import randint
 
+import magic
 from django.conf import settings
 from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import FileSystemStorage
 from django.db import transaction
-from django.db.models import Q
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils.cache import patch_vary_headers
 from knox.models import AuthToken
 from knox.serializers import UserSerializer
 from rest_framework import generics, parsers, renderers
@@ -25,12 +25,22 @@ from rest_framework.views import APIView
 from resumable.files import ResumableFile
 
 from nickelodeon.api.forms import ResumableMp3UploadForm
-from nickelodeon.api.serializers import ChangePasswordSerializer, MP3SongSerializer
-from nickelodeon.models import MP3Song
-from nickelodeon.tasks import move_files_to_destination
+from nickelodeon.api.pagination import SongCursorPagination
+from nickelodeon.api.renderers import SONG_LIST_RENDERER_CLASSES
+from nickelodeon.api.serializers import (
+    ChangePasswordSerializer,
+    MP3SongSerializer,
+    SongBulkDeleteSerializer,
+    SongLookupSerializer,
+    UploadJobSerializer,
+)
+from nickelodeon.api.uploads import MultipartResumableFile, PartUploadError
+from nickelodeon.models import MP3Song, ShuffleDeck, UploadJob, get_library_version
+from nickelodeon.tasks import delete_songs
 from nickelodeon.utils import s3_object_url
 
 MAX_SONGS_LISTED = 999
+SHUFFLE_SONGS_LISTED = 100
 
 
 def set_content_disposition(filename, dl=True):
@@ -62,11 +72,11 @@ def serve_from_s3(
 @api_view(["GET"])
 @permission_classes((IsAuthenticated,))
 def download_song(request, pk):
-    song = get_object_or_404(MP3Song.objects.select_related("owner"), pk=pk)
+    song = get_object_or_404(MP3Song, pk=pk)
     file_path = song.filename
     mime = "audio/mpeg"
     file_path = "{}.{}".format(file_path, "mp3")
-    file_path = "{}/{}".format(song.owner.settings.storage_prefix, file_path)
+    file_path = "{}/{}".format(song.storage_prefix, file_path)
     filename = song.title + ".mp3"
     return serve_from_s3(
         request,
@@ -79,26 +89,34 @@ def download_song(request, pk):
 
 class RandomSongView(generics.RetrieveAPIView):
     serializer_class = MP3SongSerializer
-    queryset = MP3Song.objects.select_related("owner").all()
+    queryset = MP3Song.objects.select_related("owner").available()
     permission_classes = (IsAuthenticated,)
 
-    @transaction.atomic
     def get_object(self):
-        count = self.get_queryset().count()
-        if count == 0:
+        song = self.get_queryset().pick_random()
+        if song is None:
             raise NotFound
-        random_index = randint(0, count - 1)
-        return self.get_queryset()[random_index]
+        return song
 
 
 class RandomSongListView(generics.ListAPIView):
     serializer_class = MP3SongSerializer
-    queryset = MP3Song.objects.select_related("owner").all()
+    queryset = MP3Song.objects.select_related("owner").available()
     permission_classes = (IsAuthenticated,)
+    renderer_classes = SONG_LIST_RENDERER_CLASSES
 
     @transaction.atomic
     def get_queryset(self):
-        return super().get_queryset().order_by("?")[:100]
+        deck = ShuffleDeck.objects.get_or_create(user=self.request.user)[0]
+        if deck.built:
+            deck = ShuffleDeck.objects.select_for_update().get(pk=deck.pk)
+            song_ids = deck.deal(SHUFFLE_SONGS_LISTED)
+        else:
+            # Until the deck is built out of the request by the
+            # process_uploads worker
+            song_ids = MP3Song.objects.sample_ids(SHUFFLE_SONGS_LISTED)
+        songs = super().get_queryset().in_bulk(song_ids)
+        return [songs[song_id] for song_id in song_ids if song_id in songs]
 
 
 class PasswordChangeView(APIView):
@@ -136,16 +154,156 @@ class SongView(generics.RetrieveUpdateDestroyAPIView):
         super(SongView, self).perform_destroy(instance)
 
 
+class SongBulkDeleteView(GenericAPIView):
+    """
+    Delete songs in bulk
+
+    ids -- Ids of the songs to delete, up to 5000
+    folder -- Or the folder whose songs are all deleted
+    """
+
+    serializer_class = SongBulkDeleteSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        songs = MP3Song.objects.all()
+        if not request.user.is_superuser:
+            songs = songs.filter(owner=request.user)
+        failed = []
+        ids = serializer.validated_data.get("ids")
+        if ids is not None:
+            songs = list(songs.filter(id__in=ids))
+            found_ids = {song.id for song in songs}
+            failed = [
+                {"id": song_id, "error": "Not found"}
+                for song_id in dict.fromkeys(ids)
+                if song_id not in found_ids
+            ]
+        else:
+            songs = list(
+                songs.filter(
+                    owner=request.user,
+                    filename__startswith=serializer.validated_data["folder"],
+                )
+            )
+        deleted, errors = delete_songs(songs)
+        failed += [{"id": song.id, "error": error} for song, error in errors]
+        return Response({"deleted": [song.id for song in deleted], "failed": failed})
+
+
+class SongLookupView(GenericAPIView):
+    """
+    Fetch songs by id
+
+    ids -- Ids of the songs to fetch, up to 1000
+    """
+
+    serializer_class = SongLookupSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data["ids"]))
+        songs = MP3Song.objects.select_related("owner").in_bulk(ids)
+        return Response(
+            {
+                "results": MP3SongSerializer(
+                    [songs[song_id] for song_id in ids if song_id in songs],
+                    many=True,
+                    context=self.get_serializer_context(),
+                ).data,
+                "missing": [song_id for song_id in ids if song_id not in songs],
+            }
+        )
+
+
 class TextSearchApiView(generics.ListAPIView):
     """
     Search Songs API
 
     q -- Search terms (Default: '')
+    page_size -- Paginate the results, pages are linked by cursors
+    cursor -- Cursor of the page to fetch, as found in the next/previous links
+    format -- columns for JSON columns, msgpack for MessagePack columns, also
+              negotiated with the Accept header
     """
 
-    queryset = MP3Song.objects.select_related("owner").all()
+    queryset = MP3Song.objects.select_related("owner").available()
     serializer_class = MP3SongSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = SongCursorPagination
+    renderer_classes = SONG_LIST_RENDERER_CLASSES
+
+    def get_cache_key(self):
+        """
+        Results only depend on the parameters, the format and the site, on
+        the user when restricted to their songs, and on the version of the
+        library, bumped whenever songs are written.
+        """
+        request = self.request
+        params = sorted(
+            (key, value)
+            for key, values in request.query_params.lists()
+            if key != "auth_token"
+            for value in values
+        )
+        user = request.user.id if request.query_params.get("o", "").strip() else ""
+        key = repr(
+            (
+                get_library_version(),
+                request.build_absolute_uri("/"),
+                request.accepted_media_type,
+                params,
+                user,
+            )
+        )
+        return "song-search:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        """
+        Gzipped bodies are cached for settings.SONG_SEARCH_CACHE_TIMEOUT
+        seconds, except the browsable API pages.
+        """
+        accept_encoding = request.META.get("HTTP_ACCEPT_ENCODING", "")
+        if "gzip" not in accept_encoding or request.accepted_renderer.format == "api":
+            return super().list(request, *args, **kwargs)
+        cache_key = self.get_cache_key()
+        cached = cache.get(cache_key)
+        if cached is None:
+            response = self.finalize_response(
+                request, super().list(request, *args, **kwargs)
+            )
+            if response.status_code != 200:
+                return response
+            cached = (
+                gzip.compress(response.rendered_content),
+                response["Content-Type"],
+            )
+            cache.set(
+                cache_key,
+                cached,
+                getattr(settings, "SONG_SEARCH_CACHE_TIMEOUT", 60),
+            )
+        body, content_type = cached
+        response = HttpResponse(body, content_type=content_type)
+        response["Content-Encoding"] = "gzip"
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
+
+    @property
+    def is_paginated(self):
+        # Without pagination parameters keep returning a plain list capped at
+        # MAX_SONGS_LISTED, as the existing clients expect.
+        params = self.request.query_params
+        return "cursor" in params or "page_size" in params
+
+    def paginate_queryset(self, queryset):
+        if not self.is_paginated:
+            return None
+        return super().paginate_queryset(queryset)
 
     def get_queryset(self):
         qs = super(TextSearchApiView, self).get_queryset()
@@ -156,25 +314,11 @@ class TextSearchApiView(generics.ListAPIView):
         if only_own:
             qs = qs.filter(owner=self.request.user)
         search_text = self.request.query_params.get("q", "").strip()
-        if search_text:
-            quoted_terms = re.findall(r"\"(.+?)\"", search_text)
-            if quoted_terms:
-                search_text = re.sub(r"\"(.+?)\"", "", search_text)
-            search_terms = search_text.split(" ")
-            query = Q()
-            for search_term in search_terms + quoted_terms:
-                if (
-                    settings.DATABASES["default"]["ENGINE"]
-                    == "django.db.backends.postgresql"
-                ):
-                    key = "filename__unaccent__icontains"
-                else:
-                    key = "filename__icontains"
-                query &= Q(**{key: search_term})
-            qs = qs.filter(query)
-        else:
+        if not search_text:
             return qs.none()
-        qs = qs.order_by("filename")[:MAX_SONGS_LISTED]
+        if self.is_paginated:
+            return qs.search(search_text, ranked=False)
+        qs = qs.search(search_text)[:MAX_SONGS_LISTED]
         return qs
 
 
@@ -232,7 +376,7 @@ class ResumableUploadView(APIView):
 
         if not request.GET.get("resumableFilename"):
             return render(request, "upload.html", {"form": ResumableMp3UploadForm()})
-        rf = ResumableFile(self.storage, request.GET)
+        rf = self.get_resumable_file(request.user, request.GET)
         if not (rf.chunk_exists or rf.is_complete):
             return HttpResponse("chunk not found", status=404)
         return HttpResponse("chunk already exists")
@@ -242,46 +386,68 @@ class ResumableUploadView(APIView):
         Saves chunks then checks if the file is complete.
         """
         chunk = request.FILES.get("file")
-        rf = ResumableFile(self.storage, request.POST)
+        rf = self.get_resumable_file(request.user, request.POST)
         ext = rf.filename[rf.filename.rfind(".") :]
         if ext.lower() != ".mp3":
             return HttpResponse("Only MP3 files are allowed", status=400)
+        error_response = self.validate_upload(rf, chunk)
+        if error_response is not None:
+            rf.delete_chunks()
+            return error_response
         if rf.chunk_exists and not rf.is_complete:
             return HttpResponse("chunk already exists")
         elif not rf.chunk_exists:
             try:
                 rf.process_chunk(chunk)
+            except PartUploadError as e:
+                # resumable.js sends the chunk again on this status
+                return HttpResponse(str(e), status=503)
             except Exception:
                 pass
         if rf.is_complete:
-            try:
-                self.process_file(
-                    request.user, request.POST.get("resumableFilename"), rf
-                )
-                rf.delete_chunks()
-            except Exception:
-                pass
+            job = self.enqueue_file(
+                request.user, request.POST.get("resumableFilename"), rf
+            )
+            serializer = UploadJobSerializer(job, context={"request": request})
+            return Response(serializer.data)
         return HttpResponse()
 
-    def process_file(self, user, filename, rfile):
+    def validate_upload(self, rf, chunk):
         """
-        Process the complete file.
+        Rejects files larger than settings.UPLOAD_MAX_SIZE and, as soon as
+        their first chunk is received, files that are not MPEG audio.
+        The status codes used make resumable.js give up on the file.
         """
-        root_folder = user.settings.storage_prefix
-        if not self.storage.exists(rfile.filename):
-            self.storage.save(rfile.filename, rfile)
-        now = datetime.datetime.now()
-        dest = os.path.join(root_folder, "Assorted", "by_date", now.strftime("%Y/%m"))
-        mp3_path = os.path.abspath(os.path.join(self.chunks_dir, rfile.filename))
-        final_filename = move_files_to_destination(
-            dest, filename[:-4], ["mp3"], {"mp3": mp3_path}
-        )
-        final_path = os.path.join(dest, final_filename)
-        mp3 = MP3Song.objects.create(
-            filename=final_path[len(root_folder) + 1 :], owner=user
-        )
-        mp3.get_duration()
-        return True
+        total_size = int(rf.kwargs.get("resumableTotalSize", 0))
+        if total_size > getattr(settings, "UPLOAD_MAX_SIZE", 1024**3):
+            return HttpResponse("File too large", status=400)
+        if chunk is None or rf.kwargs.get("resumableChunkNumber") != "1":
+            return None
+        mime = magic.from_buffer(chunk.read(2048), mime=True)
+        chunk.seek(0)
+        if mime not in ResumableMp3UploadForm.base_fields["file"].allowed_mimes:
+            return HttpResponse("Only MP3 files are allowed", status=415)
+        return None
+
+    def get_resumable_file(self, user, kwargs):
+        if getattr(settings, "S3_MULTIPART_UPLOADS", False):
+            return MultipartResumableFile(self.storage, kwargs, user)
+        return ResumableFile(self.storage, kwargs)
+
+    def enqueue_file(self, user, filename, rfile):
+        """
+        Queue the complete file to be processed by the process_uploads
+        command, unless it already is. A unique constraint on the active
+        jobs settles concurrent requests completing the same file.
+        """
+        total_size = int(rfile.kwargs.get("resumableTotalSize"))
+        return UploadJob.objects.get_or_create(
+            owner=user,
+            filename=filename,
+            total_size=total_size,
+            status__in=(UploadJob.PENDING, UploadJob.RUNNING),
+            defaults={"session": getattr(rfile, "session", None)},
+        )[0]
 
     @property
     def chunks_dir(self):
@@ -293,3 +459,11 @@ class ResumableUploadView(APIView):
     @property
     def storage(self):
         return FileSystemStorage(location=self.chunks_dir)
+
+
+class UploadJobView(generics.RetrieveAPIView):
+    serializer_class = UploadJobSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return UploadJob.objects.select_related("song").filter(owner=self.request.user)
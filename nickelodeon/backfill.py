@@ -0,0 +1,158 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+
+from nickelodeon.models import BackfillCheckpoint, MP3Song
+from nickelodeon.utils import in_shard, s3_object_content_hash
+
+
+class BackfillStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.songs = 0
+        self.updated = 0
+        self.errors = 0
+        self.bytes_transferred = 0
+
+    @property
+    def elapsed(self):
+        return max(time.monotonic() - self.start, 1e-6)
+
+    @property
+    def songs_per_second(self):
+        return self.songs / self.elapsed
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_transferred / self.elapsed
+
+
+class Backfill:
+    """
+    Fills metadata fields of the songs returned by get_queryset. Songs are
+    fetched in batches ordered by id, computed by a pool of threads sharing
+    the S3 client and saved with one bulk_update per batch. The id of the
+    last song of each batch is checkpointed, an interrupted run resumes
+    after it.
+
+    With a shard (index, count), only the songs whose id hashes to the
+    shard are processed and the shard has its own checkpoint, so several
+    hosts can split a backfill.
+
+    Subclasses set name and fields, and implement get_queryset and compute.
+    """
+
+    name = None
+    fields = ()
+
+    def __init__(self, shard=None):
+        self.shard = shard
+
+    @property
+    def checkpoint_name(self):
+        if self.shard is None:
+            return self.name
+        return "{}:{}/{}".format(self.name, *self.shard)
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def compute(self, song):
+        """
+        Returns a dict of the values of fields for song, or None if they can
+        not be computed, and the number of bytes downloaded to do so.
+        """
+        raise NotImplementedError
+
+    def get_pending_queryset(self, last_id=""):
+        return self.get_queryset().filter(id__gt=last_id).order_by("id")
+
+    def get_checkpoint(self):
+        return BackfillCheckpoint.objects.get_or_create(name=self.checkpoint_name)[0]
+
+    def count_pending(self, last_id=""):
+        song_ids = self.get_pending_queryset(last_id).values_list("id", flat=True)
+        return sum(
+            1 for song_id in song_ids.iterator() if in_shard(song_id, self.shard)
+        )
+
+    def safe_compute(self, song):
+        # A song that fails, e.g. with a missing file, is counted as an error
+        try:
+            return self.compute(song)
+        except Exception:
+            return False, 0
+
+    def run(self, workers=1, batch_size=500, restart=False, callback=None):
+        """
+        callback is called after every batch with the number of songs of
+        the batch and the stats of the run.
+        """
+        checkpoint = self.get_checkpoint()
+        if restart:
+            checkpoint.last_id = ""
+        stats = BackfillStats()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                songs = list(self.get_pending_queryset(checkpoint.last_id)[:batch_size])
+                if not songs:
+                    break
+                last_id = songs[-1].id
+                songs = [song for song in songs if in_shard(song.id, self.shard)]
+                updated = []
+                results = executor.map(self.safe_compute, songs)
+                for song, (values, bytes_transferred) in zip(songs, results):
+                    stats.bytes_transferred += bytes_transferred
+                    if values is False:
+                        stats.errors += 1
+                    elif values:
+                        for field, value in values.items():
+                            setattr(song, field, value)
+                        updated.append(song)
+                with transaction.atomic():
+                    MP3Song.objects.bulk_update(updated, self.fields)
+                    checkpoint.last_id = last_id
+                    checkpoint.save()
+                stats.songs += len(songs)
+                stats.updated += len(updated)
+                if callback is not None:
+                    callback(len(songs), stats)
+        checkpoint.delete()
+        return stats
+
+
+class DurationBackfill(Backfill):
+    name = "duration"
+    fields = ("duration",)
+
+    def get_queryset(self):
+        return MP3Song.objects.filter(duration=0).only("id", "filename", "owner_id")
+
+    def compute(self, song):
+        duration, bytes_transferred = song.probe_duration()
+        return {"duration": duration} if duration else None, bytes_transferred
+
+
+class ContentHashBackfill(Backfill):
+    """
+    Content hashes of the songs stored before uploads were deduplicated,
+    so that uploading them again is detected.
+    """
+
+    name = "content_hash"
+    fields = ("content_hash",)
+
+    def get_queryset(self):
+        return MP3Song.objects.filter(content_hash="").only(
+            "id", "filename", "owner_id", "size"
+        )
+
+    def compute(self, song):
+        content_hash = s3_object_content_hash(song.get_file_format_path())
+        return {"content_hash": content_hash}, song.size or 0
+
+
+BACKFILLS = {
+    backfill.name: backfill for backfill in (DurationBackfill, ContentHashBackfill)
+}
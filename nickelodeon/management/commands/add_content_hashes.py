@@ -0,0 +1,7 @@
+from nickelodeon.management.commands import add_durations
+
+
+class Command(add_durations.Command):
+    help = "Add the missing content hashes for the songs in the library"
+
+    backfill = "content_hash"
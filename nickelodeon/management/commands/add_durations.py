@@ -1,32 +1,66 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
 from django.core.management.base import BaseCommand
 from tqdm import tqdm
 
-from nickelodeon.models import MP3Song
+from nickelodeon.backfill import BACKFILLS
+from nickelodeon.utils import parse_shard
 
 
 class Command(BaseCommand):
     args = ["workers"]
     help = "Add the missing durations for the songs in the library"
 
+    backfill = "duration"
+
     def add_arguments(self, parser):
         parser.add_argument("-w", "--workers", type=int, default=1)
+        parser.add_argument("-b", "--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint left by an interrupted run",
+        )
+        parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            default=None,
+            help="Process only the songs of shard INDEX/COUNT, e.g. 1/4",
+        )
 
     def handle(self, *args, **options):
-        songs = MP3Song.objects.select_related("owner").filter(duration=0)
-        song_count = songs.count()
+        backfill = BACKFILLS[self.backfill](shard=options["shard"])
+        stats = None
         try:
-            with tqdm(total=song_count, unit="song") as pbar:
-                with ThreadPoolExecutor(max_workers=options.get("workers")) as executor:
-                    future_to_song = {
-                        executor.submit(self.handle_song, song): song for song in songs
-                    }
-                    for future in as_completed(future_to_song):
-                        future_to_song[future]
-                        pbar.update(1)
-        except KeyboardInterrupt:
-            pass
+            last_id = "" if options["restart"] else backfill.get_checkpoint().last_id
+            total = backfill.count_pending(last_id)
+            with tqdm(
+                total=total,
+                unit="song",
+                desc=backfill.checkpoint_name,
+                file=self.stderr,
+            ) as pbar:
 
-    def handle_song(self, song):
-        song.get_duration()
+                def update(count, run_stats):
+                    nonlocal stats
+                    stats = run_stats
+                    pbar.update(count)
+
+                backfill.run(
+                    workers=options["workers"],
+                    batch_size=options["batch_size"],
+                    restart=options["restart"],
+                    callback=update,
+                )
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted, the next run resumes from the checkpoint")
+        if stats is not None and stats.songs:
+            self.stdout.write(
+                "{}: {} songs updated, {} errors, {:.1f} songs/s, {:.0f} bytes/s, "
+                "{} bytes per song".format(
+                    backfill.checkpoint_name,
+                    stats.updated,
+                    stats.errors,
+                    stats.songs_per_second,
+                    stats.bytes_per_second,
+                    stats.bytes_transferred // stats.songs,
+                )
+            )
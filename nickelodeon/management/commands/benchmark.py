@@ -0,0 +1,222 @@
+import random
+import statistics
+import time
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+
+from nickelodeon.api.serializers import MP3SongSerializer
+from nickelodeon.models import MP3Song
+from nickelodeon.utils import (
+    get_s3_client,
+    get_s3_presigner,
+    random_key,
+    reset_s3_connections,
+)
+
+WORDS = [
+    "amour",
+    "beyoncé",
+    "café",
+    "daft",
+    "électrique",
+    "funk",
+    "göteborg",
+    "humppa",
+    "island",
+    "jazz",
+    "kraftwerk",
+    "love",
+    "märchen",
+    "night",
+    "océan",
+    "punk",
+    "queen",
+    "rêve",
+    "soul",
+    "tango",
+    "über",
+    "voyage",
+    "wave",
+    "xylophone",
+    "yé-yé",
+    "zouk",
+]
+
+
+@contextmanager
+def scratch_database():
+    """
+    Runs the benchmarks writing synthetic songs against a throwaway copy of
+    the schema, created and destroyed like the test database, so that the
+    live library, its sequence lock and the shuffle decks are not touched.
+    """
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = max(0, round(pct / 100 * len(values)) - 1)
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = "Measure the latency of the hot code paths of the server"
+
+    targets = ("search", "s3client", "presign", "serialize")
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", choices=self.targets)
+        parser.add_argument("-n", "--runs", type=int, default=100)
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[100_000, 1_000_000, 5_000_000],
+            help="Library sizes to benchmark against",
+        )
+
+    def handle(self, *args, **options):
+        getattr(self, f"bench_{options['target']}")(**options)
+
+    def report(self, label, timings, unit="ms"):
+        self.stdout.write(
+            "{}: p50={:.2f}{unit} p95={:.2f}{unit} max={:.2f}{unit}".format(
+                label,
+                statistics.median(timings),
+                percentile(timings, 95),
+                max(timings),
+                unit=unit,
+            )
+        )
+
+    def random_filename(self, rng):
+        artist = " ".join(rng.choices(WORDS, k=2)).title()
+        album = " ".join(rng.choices(WORDS, k=2)).title()
+        title = " ".join(rng.choices(WORDS, k=3)).title()
+        track = rng.randint(1, 20)
+        return f"{artist}/{album}/{track:02d} - {title} {random_key()}"
+
+    def bench_search(self, runs, sizes, **options):
+        """
+        Fills a scratch database with synthetic songs.
+        """
+        rng = random.Random(0)
+        queries = [
+            " ".join(rng.choices(WORDS, k=rng.randint(1, 3))) for _ in range(runs)
+        ]
+        with scratch_database():
+            owner = User.objects.create(username=f"benchmark-{random_key()}")
+            count = 0
+            for size in sorted(sizes):
+                while count < size:
+                    batch = min(10_000, size - count)
+                    MP3Song.objects.bulk_create(
+                        MP3Song(filename=self.random_filename(rng), owner=owner)
+                        for _ in range(batch)
+                    )
+                    count += batch
+                if connection.vendor == "postgresql":
+                    with connection.cursor() as cursor:
+                        cursor.execute("ANALYZE nickelodeon_mp3song")
+                timings = []
+                for query in queries:
+                    t0 = time.perf_counter()
+                    list(MP3Song.objects.search(query).values_list("id")[:999])
+                    timings.append((time.perf_counter() - t0) * 1000)
+                self.report(f"search {size} songs", timings)
+
+    def bench_s3client(self, runs, **options):
+        """
+        HEAD requests with a client built for every call, as before the
+        clients were shared, then with the shared client. The client is
+        called directly, s3_object_exists would answer from the metadata
+        cache.
+        """
+        key = f"benchmark/{random_key()}.mp3"
+        for label, reset in (("new client per call", True), ("shared client", False)):
+            timings = []
+            for _ in range(runs):
+                t0 = time.perf_counter()
+                if reset:
+                    reset_s3_connections()
+                try:
+                    get_s3_client().head_object(Bucket=settings.S3_BUCKET, Key=key)
+                except ClientError:
+                    pass
+                timings.append((time.perf_counter() - t0) * 1000)
+            self.report(label, timings)
+
+    def bench_presign(self, runs, **options):
+        key = f"benchmark/{random_key()}/song.mp3"
+        s3 = get_s3_client()
+        presigners = (
+            (
+                "boto3 generate_presigned_url",
+                lambda: s3.generate_presigned_url(
+                    ClientMethod="get_object",
+                    Params={"Bucket": settings.S3_BUCKET, "Key": key},
+                ),
+            ),
+            ("S3Presigner", lambda: get_s3_presigner().url("GET", key)),
+        )
+        for label, presign in presigners:
+            t0 = time.perf_counter()
+            for _ in range(runs):
+                presign()
+            rate = runs / (time.perf_counter() - t0)
+            self.stdout.write(f"{label}: {rate:.0f} urls/s")
+
+    def bench_serialize(self, runs, sizes, **options):
+        """
+        Rows per second of the song listings, serialized row by row by
+        MP3SongSerializer as before the fast path, then by the fast path,
+        in a scratch database.
+        """
+        rng = random.Random(0)
+        request = RequestFactory().get("/")
+        context = {"request": request}
+        with scratch_database():
+            owner = User.objects.create(username=f"benchmark-{random_key()}")
+            size = min(sizes)
+            MP3Song.objects.bulk_create(
+                MP3Song(filename=self.random_filename(rng), owner=owner)
+                for _ in range(size)
+            )
+            songs = MP3Song.objects.select_related("owner").filter(owner=owner)
+            serializers = (
+                (
+                    "MP3SongSerializer per row",
+                    lambda: [
+                        MP3SongSerializer(song, context=context).data
+                        for song in songs.all()
+                    ],
+                ),
+                (
+                    "MP3SongListSerializer",
+                    lambda: MP3SongSerializer(
+                        songs.all(), many=True, context=context
+                    ).data,
+                ),
+            )
+            for label, serialize in serializers:
+                timings = []
+                for _ in range(max(1, runs // 10)):
+                    t0 = time.perf_counter()
+                    serialize()
+                    timings.append(size / (time.perf_counter() - t0))
+                self.stdout.write(
+                    "{}: {:.0f} rows/s ({} rows)".format(
+                        label, statistics.median(timings), size
+                    )
+                )
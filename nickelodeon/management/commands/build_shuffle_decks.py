@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from nickelodeon.models import ShuffleDeck
+
+
+class Command(BaseCommand):
+    help = "Deal the cards of the shuffle decks created since the last run"
+
+    def handle(self, *args, **options):
+        count = ShuffleDeck.build_pending()
+        self.stdout.write("Built {} shuffle deck(s)".format(count))
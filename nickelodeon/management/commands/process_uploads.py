@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from nickelodeon.models import ShuffleDeck, UploadJob
+from nickelodeon.tasks import finalize_upload, roll_forward_moves
+
+
+class Command(BaseCommand):
+    help = (
+        "Finalize the complete uploads waiting in the queue, build the new "
+        "shuffle decks and roll forward the interrupted song moves while it "
+        "is empty"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Exit when the queue is empty"
+        )
+        parser.add_argument("--sleep", type=float, default=1)
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=3600,
+            help="Seconds after which a running job is considered abandoned",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                job = UploadJob.claim(options["timeout"])
+                if job is None:
+                    self.run_idle_tasks()
+                    if options["once"]:
+                        break
+                    time.sleep(options["sleep"])
+                    continue
+                self.process_job(job)
+        except KeyboardInterrupt:
+            pass
+
+    def run_idle_tasks(self):
+        count = ShuffleDeck.build_pending()
+        if count:
+            self.stdout.write(f"Built {count} shuffle deck(s)")
+        songs = roll_forward_moves()
+        if songs:
+            self.stdout.write(f"Moved the files of {len(songs)} song(s)")
+
+    def process_job(self, job):
+        try:
+            job.song = finalize_upload(job, settings.FILE_UPLOAD_TEMP_DIR)
+        except Exception as e:
+            job.status = UploadJob.FAILED
+            job.error = str(e)
+            self.stderr.write(f"Upload {job.id} of {job.filename} failed: {e}")
+        else:
+            job.status = UploadJob.DONE
+            self.stdout.write(f"Upload {job.id} stored as {job.song.filename}")
+        job.save()
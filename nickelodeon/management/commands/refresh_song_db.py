@@ -1,47 +1,125 @@
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.db import connection, models
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Collate, Concat
 
-from nickelodeon.models import MP3Song, UserSettings
-from nickelodeon.utils import get_s3_client
+from nickelodeon.models import (
+    MP3Song,
+    ScanManifest,
+    SongMove,
+    UserSettings,
+    get_storage_prefix,
+)
+from nickelodeon.utils import get_s3_client, in_shard, parse_shard
 
 MP3_FILE_EXT_RE = re.compile(r"(.+)\.mp3$", re.IGNORECASE)
+BATCH_SIZE = 1000
+
+
+def iter_prefix(prefix, recursive=True):
+    """
+    Yields the MP3 files under prefix, or only those directly under it when
+    not recursive, in the binary order of their keys.
+    """
+    for page in paginate_prefix(prefix, recursive):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".mp3"):
+                yield obj
+
+
+def list_sub_prefixes(prefix):
+    sub_prefixes = []
+    for page in paginate_prefix(prefix, recursive=False):
+        sub_prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+    return sub_prefixes
+
+
+def paginate_prefix(prefix, recursive):
+    s3 = get_s3_client()
+    # Should use v2 but wasabi fails to list all files with it
+    # paginator = s3.get_paginator('list_objects_v2')
+    paginator = s3.get_paginator("list_objects")
+    kwargs = {
+        "Bucket": settings.S3_BUCKET,
+        "Prefix": prefix,
+    }
+    if not recursive:
+        kwargs["Delimiter"] = "/"
+    return paginator.paginate(**kwargs)
+
+
+def summarize_prefix(prefix, recursive=True):
+    """
+    Number of MP3 files and most recent modification date under prefix.
+    """
+    summary = (0, None)
+    for obj in iter_prefix(prefix, recursive):
+        summary = add_to_summary(summary, obj)
+    return summary
+
+
+def add_to_summary(summary, obj):
+    count, last_modified = summary
+    if last_modified is None or obj["LastModified"] > last_modified:
+        last_modified = obj["LastModified"]
+    return count + 1, last_modified
 
 
 class Command(BaseCommand):
     args = "[folders]"
     help = "Scan the media folder and update the database of music files"
 
-    songs_to_find = set()
-    songs_to_remove = set()
-    songs_to_add = set()
     t0 = t1 = last_flush = songs_count = 0
     encoding = "UTF-8"
     root = None
     owner = None
+    storage_prefix = None
 
     def add_arguments(self, parser):
         parser.add_argument("folders", nargs="*", type=str)
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Compare the whole folders with the database, "
+            "including the prefixes unchanged since the last scan",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=8,
+            help="Number of prefixes listed concurrently",
+        )
+        parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            default=None,
+            help="Scan only the folders of shard INDEX/COUNT, e.g. 1/4",
+        )
 
-    def handle_folder(self, root):
-        self.root = root + "/"
-        self.t0 = self.last_flush = time.time()
+    def handle_folder(self, root, summaries=None):
+        """
+        summaries maps the (prefix, recursive) keys of the top level
+        prefixes of the folder to the futures of their summary, only the
+        prefixes whose summary differs from their manifest are compared
+        with the database. Without summaries the whole folder is compared.
+        """
+        self.root = root
+        self.t0 = self.t1 = self.last_flush = time.time()
 
         self.songs_count = 0
-        self.songs = []
+        self.songs_to_add = []
+        self.songs_to_remove = []
+        self.nb_songs_added = self.nb_songs_removed = 0
 
         self.stdout.write("Scanning directory {} for music".format(self.root))
-        self.t1 = self.last_flush = time.time()
-
-        for filename in self.scan_directory():
-            self.process_music_file(filename)
-
-        self.print_scan_status(True)
 
-        prefix = self.root
         root_folder = self.root[: self.root.find("/")]
         try:
             self.owner = UserSettings.objects.get_or_create(storage_prefix=root_folder)[
@@ -49,67 +127,163 @@ class Command(BaseCommand):
             ].user
         except UserSettings.DoesNotExist:
             self.owner = User.objects.get(username=root_folder)
+        self.storage_prefix = get_storage_prefix(self.owner.id)
 
-        current_songs_qs = MP3Song.objects.filter(owner=self.owner)
-        prefix = prefix[len(root_folder) + 1 :]
-        if prefix:
-            current_songs_qs = current_songs_qs.filter(filename__startswith=prefix)
+        manifests = {
+            (m.prefix, m.recursive): m
+            for m in ScanManifest.objects.filter(prefix__startswith=self.root)
+            if (m.prefix, m.recursive) == (self.root, False)
+            or (m.recursive and "/" not in m.prefix[len(self.root) : -1])
+        }
+        if summaries is None:
+            summaries = {(self.root, False): (0, None)}
+            self.diff_prefix(self.root, True, self.tally(summaries))
+        else:
+            summaries = {key: future.result() for key, future in summaries.items()}
+            for key, summary in summaries.items():
+                manifest = manifests.get(key)
+                if manifest is None or summary != (
+                    manifest.object_count,
+                    manifest.last_modified,
+                ):
+                    self.diff_prefix(*key, iter_prefix(*key))
+            for key in manifests.keys() - summaries.keys():
+                # Prefix deleted since the last scan
+                self.diff_prefix(*key, [])
 
-        current_songs = set(
-            [
-                f"{self.owner.settings.storage_prefix}/{s.filename}"
-                for s in current_songs_qs
-            ]
+        self.print_scan_status(True)
+        self.finalize()
+
+        for (prefix, recursive), (count, last_modified) in summaries.items():
+            ScanManifest.objects.update_or_create(
+                prefix=prefix,
+                recursive=recursive,
+                defaults={"object_count": count, "last_modified": last_modified},
+            )
+        ScanManifest.objects.filter(
+            pk__in=[m.pk for key, m in manifests.items() if key not in summaries]
+        ).delete()
+
+    def tally(self, summaries):
+        """
+        Lists the whole folder, summarizing its top level prefixes on the way.
+        """
+        for obj in iter_prefix(self.root):
+            rest = obj["Key"][len(self.root) :]
+            if "/" in rest:
+                key = (self.root + rest[: rest.index("/") + 1], True)
+            else:
+                key = (self.root, False)
+            summaries[key] = add_to_summary(summaries.get(key, (0, None)), obj)
+            yield obj
+
+    def current_song_keys(self, prefix, recursive):
+        """
+        Yields the keys of the files of the songs under prefix, in the same
+        binary order as the bucket listings.
+        """
+        filename_prefix = prefix[len(self.storage_prefix) + 1 :]
+        key = Concat("filename", models.Value(".mp3"), output_field=models.TextField())
+        if connection.vendor == "postgresql":
+            key = Collate(key, "C")
+        filenames = (
+            MP3Song.objects.filter(
+                owner=self.owner, filename__startswith=filename_prefix
+            )
+            .annotate(key=key)
+            .order_by("key")
+            .values_list("filename", flat=True)
         )
+        for filename in filenames.iterator(chunk_size=BATCH_SIZE):
+            if recursive or "/" not in filename[len(filename_prefix) :]:
+                yield f"{self.storage_prefix}/{filename}.mp3"
 
-        self.songs = set(self.songs)
-        self.songs_to_remove = [
-            song for song in current_songs if song not in self.songs
-        ]
-        self.songs_to_add = [song for song in self.songs if song not in current_songs]
-        self.finalize()
+    def diff_prefix(self, prefix, recursive, objects):
+        """
+        Merges the sorted listing of the bucket with the sorted files of the
+        songs, additions and removals are flushed in batches.
+        """
+        objects = iter(objects)
+        song_keys = self.current_song_keys(prefix, recursive)
+        obj = next(objects, None)
+        song_key = next(song_keys, None)
+        while obj is not None or song_key is not None:
+            if song_key is None or (obj is not None and obj["Key"] < song_key):
+                self.process_music_file(obj)
+            elif obj is None or song_key < obj["Key"]:
+                self.songs_to_remove.append(song_key[:-4])
+                if len(self.songs_to_remove) >= BATCH_SIZE:
+                    self.bulk_remove()
+                song_key = next(song_keys, None)
+                continue
+            else:
+                song_key = next(song_keys, None)
+            self.songs_count += 1
+            self.print_scan_status()
+            obj = next(objects, None)
 
     def handle(self, *args, **options):
         folders = options["folders"]
         if not folders:
-            folders = [u.settings.storage_prefix for u in User.objects.all()]
-        for folder in folders:
-            self.handle_folder(folder)
+            folders = [
+                (
+                    u.usersettings.storage_prefix
+                    if hasattr(u, "usersettings")
+                    else u.settings.storage_prefix
+                )
+                for u in User.objects.select_related("usersettings")
+            ]
+        roots = [
+            folder.rstrip("/") + "/"
+            for folder in folders
+            if in_shard(folder.rstrip("/"), options["shard"])
+        ]
+        if options["shard"] is not None:
+            self.stdout.write(
+                "Shard {}/{}: {} of {} folder(s)".format(
+                    *options["shard"], len(roots), len(folders)
+                )
+            )
+        # Without a manifest of the folder, prefixes deleted since the songs
+        # were added could be missed, the whole folder is compared
+        scanned_roots = set(
+            ScanManifest.objects.filter(prefix__in=roots, recursive=False).values_list(
+                "prefix", flat=True
+            )
+        )
+        if options["full"]:
+            scanned_roots = set()
+        # Folders of all users are listed concurrently, their top level
+        # prefixes fanned out over the pool, then compared one by one
+        with ThreadPoolExecutor(max_workers=options["jobs"]) as pool:
+            sub_prefixes = {
+                root: pool.submit(list_sub_prefixes, root)
+                for root in roots
+                if root in scanned_roots
+            }
+            folder_summaries = {}
+            for root, future in sub_prefixes.items():
+                summaries = folder_summaries[root] = {
+                    (root, False): pool.submit(summarize_prefix, root, False)
+                }
+                for sub_prefix in future.result():
+                    summaries[(sub_prefix, True)] = pool.submit(
+                        summarize_prefix, sub_prefix
+                    )
+            for root in roots:
+                self.handle_folder(root, folder_summaries.get(root))
 
     def finalize(self):
-        nb_songs_to_add = len(self.songs_to_add)
-        nb_songs_to_remove = len(self.songs_to_remove)
-        self.stdout.write("\nDiscovered {} new file(s)".format(nb_songs_to_add))
-        self.stdout.write("Removing {} file(s)".format(nb_songs_to_remove))
-        if nb_songs_to_add > 0:
-            self.bulk_create()
-        if nb_songs_to_remove > 0:
-            self.bulk_remove()
+        self.bulk_create()
+        self.bulk_remove()
+        self.stdout.write("\nDiscovered {} new file(s)".format(self.nb_songs_added))
+        self.stdout.write("Removed {} file(s)".format(self.nb_songs_removed))
         self.stdout.write(
             "Task completed in {} seconds".format(round(time.time() - self.t0, 1))
         )
 
-    def scan_directory(self):
-        s3 = get_s3_client()
-        # Should use v2 but wasabi fails to list all files with it
-        # paginator = s3.get_paginator('list_objects_v2')
-        paginator = s3.get_paginator("list_objects")
-        kwargs = {
-            "Bucket": settings.S3_BUCKET,
-            "Prefix": self.root,
-        }
-        for page in paginator.paginate(**kwargs):
-            try:
-                contents = page["Contents"]
-            except KeyError:
-                break
-
-            for obj in contents:
-                key = obj["Key"]
-                if key.endswith(".mp3"):
-                    yield key
-
-    def process_music_file(self, media_path):
+    def process_music_file(self, obj):
+        media_path = obj["Key"]
         if not MP3_FILE_EXT_RE.search(media_path):
             return
         if len(media_path) > 255:
@@ -117,15 +291,20 @@ class Command(BaseCommand):
                 "Media path too long, " "255 characters maximum. %s" % media_path
             )
             return
-        self.songs.append(media_path[:-4])
-        self.songs_count += 1
-        self.print_scan_status()
+        song = MP3Song(
+            filename=media_path[len(self.storage_prefix) + 1 : -4],
+            owner=self.owner,
+        )
+        song.set_file_metadata({"size": obj["Size"], "etag": obj["ETag"].strip('"')})
+        self.songs_to_add.append(song)
+        if len(self.songs_to_add) >= BATCH_SIZE:
+            self.bulk_create()
 
     def print_scan_status(self, force=False):
         if time.time() - self.last_flush > 1 or force:
             self.last_flush = time.time()
             self.stdout.write(
-                "\rScanned {} music file(s) in {} seconds".format(
+                "\rCompared {} music file(s) in {} seconds".format(
                     self.songs_count, round(time.time() - self.t1, 1)
                 ),
                 ending="",
@@ -133,19 +312,38 @@ class Command(BaseCommand):
             self.stdout.flush()
 
     def bulk_create(self):
-        bulk = []
-        for song_file in self.songs_to_add:
-            bulk.append(
-                MP3Song(
-                    filename=song_file[len(self.owner.settings.storage_prefix) + 1 :],
-                    owner=self.owner,
-                )
-            )
-        MP3Song.objects.bulk_create(bulk)
+        if not self.songs_to_add:
+            return
+        # Files being moved are already in the library under their new name
+        moving = set(
+            SongMove.objects.filter(
+                song__owner=self.owner,
+                src_key__in=[song.get_file_format_path() for song in self.songs_to_add],
+            ).values_list("src_key", flat=True)
+        )
+        songs = [
+            song
+            for song in self.songs_to_add
+            if song.get_file_format_path() not in moving
+        ]
+        # Songs created meanwhile by an upload are left as they are
+        created = MP3Song.objects.bulk_create(songs, ignore_conflicts=True)
+        self.nb_songs_added += len(created)
+        self.songs_to_add = []
 
     def bulk_remove(self):
+        if not self.songs_to_remove:
+            return
         files = []
-        root_folder_len = len(self.owner.settings.storage_prefix) + 1
+        root_folder_len = len(self.storage_prefix) + 1
         for song_file in self.songs_to_remove:
             files.append(song_file[root_folder_len:])
-        MP3Song.objects.filter(owner_id=self.owner.id, filename__in=set(files)).delete()
+        # Songs reserved by an upload or being moved have no file yet
+        deleted = (
+            MP3Song.objects.filter(owner_id=self.owner.id, filename__in=files)
+            .exclude(mp3_available=False)
+            .exclude(Exists(SongMove.objects.filter(song=OuterRef("pk"))))
+            .delete()[1]
+        )
+        self.nb_songs_removed += deleted.get(MP3Song._meta.label, 0)
+        self.songs_to_remove = []
@@ -1,6 +1,8 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from nickelodeon.models import MP3Song
+from nickelodeon.models import MP3Song, SongMove
+from nickelodeon.tasks import FilenameConflict, move_songs, roll_forward_moves
+from nickelodeon.utils import in_shard, parse_shard
 
 
 class Command(BaseCommand):
@@ -11,6 +13,12 @@ class Command(BaseCommand):
         parser.add_argument("-q", "--query", type=str, required=True)
         parser.add_argument("-r", "--replace", type=str, default=None)
         parser.add_argument("--dryrun", action="store_true")
+        parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            default=None,
+            help="Process only the songs of shard INDEX/COUNT, e.g. 1/4",
+        )
 
     def handle(self, *args, **options):
         songs = (
@@ -18,6 +26,7 @@ class Command(BaseCommand):
             .filter(filename__contains=options["query"])
             .order_by("filename")
         )
+        songs = (song for song in songs if in_shard(song.id, options["shard"]))
         try:
             if (replace_str := options["replace"]) is None:
                 for song in songs:
@@ -26,6 +35,7 @@ class Command(BaseCommand):
                     )
                     print(text_to_print)
             else:
+                moves = []
                 for song in songs:
                     target = song.filename.replace(options["query"], replace_str)
                     text_to_print = song.filename.replace(
@@ -33,8 +43,17 @@ class Command(BaseCommand):
                         f"\033[91m{options["query"]}\033[0m\033[92m{replace_str}\033[0m",
                     )
                     print(text_to_print)
-                    if not options["dryrun"]:
-                        song.move_file_to(target)
-                        song.save()
+                    moves.append((song, target))
+                if not options["dryrun"]:
+                    roll_forward_moves()
+                    move_songs(moves)
+                    failed = SongMove.objects.exclude(error="").count()
+                    if failed:
+                        self.stderr.write(
+                            f"{failed} file(s) could not be moved yet, "
+                            "they are retried by the next run"
+                        )
         except KeyboardInterrupt:
             pass
+        except FilenameConflict as e:
+            raise CommandError(str(e))
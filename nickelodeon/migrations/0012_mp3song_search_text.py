@@ -0,0 +1,57 @@
+# Generated by Django 5.2.11 on 2026-10-18 06:43
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+from nickelodeon.utils import normalize_search_text
+
+SEARCH_INDEXES = {
+    "nickelodeon_mp3song_search_trgm": "USING gin (search_text gin_trgm_ops)",
+}
+
+
+def fill_search_text(apps, schema_editor):
+    MP3Song = apps.get_model("nickelodeon", "MP3Song")
+    batch = []
+    for song in MP3Song.objects.only("id", "filename").iterator(chunk_size=2000):
+        song.search_text = normalize_search_text(song.filename)
+        batch.append(song)
+        if len(batch) >= 2000:
+            MP3Song.objects.bulk_update(batch, ["search_text"])
+            batch = []
+    if batch:
+        MP3Song.objects.bulk_update(batch, ["search_text"])
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name, definition in SEARCH_INDEXES.items():
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON nickelodeon_mp3song {definition}"
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name in SEARCH_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0011_alter_mp3song_unique_together_and_more"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name="mp3song",
+            name="search_text",
+            field=models.TextField(default="", editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.11 on 2026-10-18 06:47
+
+from django.db import migrations, models
+
+
+def number_songs(apps, schema_editor):
+    MP3Song = apps.get_model("nickelodeon", "MP3Song")
+    MP3SongSequence = apps.get_model("nickelodeon", "MP3SongSequence")
+    count = 0
+    batch = []
+    for song in MP3Song.objects.only("id").order_by("id").iterator(chunk_size=2000):
+        count += 1
+        song.seq = count
+        batch.append(song)
+        if len(batch) >= 2000:
+            MP3Song.objects.bulk_update(batch, ["seq"])
+            batch = []
+    if batch:
+        MP3Song.objects.bulk_update(batch, ["seq"])
+    MP3SongSequence.objects.update_or_create(pk=1, defaults={"count": count})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0012_mp3song_search_text"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MP3SongSequence",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="mp3song",
+            name="seq",
+            field=models.PositiveIntegerField(editable=False, null=True, unique=True),
+        ),
+        migrations.RunPython(number_songs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.11 on 2026-10-18 06:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0014_shuffledeck_shuffledeckcard"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mp3song",
+            name="etag",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="mp3song",
+            name="mp3_available",
+            field=models.BooleanField(null=True),
+        ),
+        migrations.AddField(
+            model_name="mp3song",
+            name="size",
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.11 on 2026-10-18 06:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0015_mp3song_etag_mp3song_mp3_available_mp3song_size"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadSession",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("identifier", models.CharField(max_length=255)),
+                ("key", models.CharField(max_length=1024)),
+                (
+                    "upload_id",
+                    models.CharField(blank=True, default="", max_length=1024),
+                ),
+                ("parts", models.JSONField(default=dict)),
+                ("creation_date", models.DateTimeField(auto_now_add=True)),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("owner", "identifier"),
+                        name="unique_owner_upload_identifier",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.11 on 2026-10-18 07:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0017_uploadjob"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mp3song",
+            name="content_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="uploadjob",
+            name="duplicate",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name="mp3song",
+            index=models.Index(
+                fields=["owner", "content_hash"], name="nickelodeon_owner_i_ae3df5_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-18 07:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0018_mp3song_content_hash_uploadjob_duplicate_and_more"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="uploadjob",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status__in", ["pending", "running"])),
+                fields=("owner", "filename", "total_size"),
+                name="unique_active_upload_job",
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.11 on 2026-10-18 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0019_uploadjob_unique_active_upload_job"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScanManifest",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("prefix", models.CharField(max_length=1024)),
+                ("recursive", models.BooleanField(default=True)),
+                ("object_count", models.PositiveIntegerField(default=0)),
+                ("last_modified", models.DateTimeField(blank=True, null=True)),
+                ("scan_date", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("prefix", "recursive"),
+                        name="unique_scan_manifest_prefix",
+                    )
+                ],
+            },
+        ),
+    ]
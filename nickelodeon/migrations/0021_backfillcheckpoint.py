@@ -0,0 +1,30 @@
+# Generated by Django 5.2.11 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0020_scanmanifest"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BackfillCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=64, unique=True)),
+                ("last_id", models.CharField(blank=True, default="", max_length=12)),
+                ("modification_date", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.11 on 2026-10-18 07:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nickelodeon", "0021_backfillcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SongMove",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("src_key", models.CharField(max_length=1024)),
+                ("dst_key", models.CharField(max_length=1024)),
+                ("filename", models.CharField(max_length=255)),
+                ("copied", models.BooleanField(default=False)),
+                ("error", models.TextField(blank=True, default="")),
+                ("creation_date", models.DateTimeField(auto_now_add=True)),
+                ("modification_date", models.DateTimeField(auto_now=True)),
+                (
+                    "song",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="nickelodeon.mp3song",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["modification_date"],
+                        name="nickelodeon_modific_c36c4f_idx",
+                    )
+                ],
+            },
+        ),
+    ]
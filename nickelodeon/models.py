@@ -1,21 +1,38 @@
 from __future__ import unicode_literals
 
+import datetime
 import os
 import re
-from io import BytesIO
+import time
+from functools import lru_cache
+from random import randint, sample, shuffle, uniform
 
-import mutagen
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    TrigramWordSimilarity,
+)
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.db.models.functions import Random
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
 
 from nickelodeon.utils import (
+    S3RangeReader,
+    content_hash,
+    get_mp3_duration,
+    normalize_search_text,
     random_key,
-    s3_get_file,
-    s3_move_object,
     s3_object_delete,
     s3_object_exists,
+    s3_object_metadata,
 )
 
 
@@ -31,6 +48,12 @@ class UserSettings(models.Model):
         if not self.storage_prefix:
             self.storage_prefix = f"{self.username}-{random_key()}"
         super().save(*args, **kwargs)
+        get_storage_prefix.cache_clear()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        get_storage_prefix.cache_clear()
+        return result
 
 
 User.settings = property(
@@ -40,22 +63,288 @@ User.settings = property(
 )
 
 
+def get_storage_prefix(user_id):
+    """
+    Storage prefix of a user, cached in the process for
+    settings.STORAGE_PREFIX_CACHE_TIMEOUT seconds so that changes made by
+    other processes are picked up. Saving or deleting a UserSettings clears
+    the cache of the current process right away.
+    """
+    timeout = getattr(settings, "STORAGE_PREFIX_CACHE_TIMEOUT", 60)
+    return _get_storage_prefix(user_id, int(time.monotonic() // timeout))
+
+
+@lru_cache(maxsize=4096)
+def _get_storage_prefix(user_id, period):
+    prefix = (
+        UserSettings.objects.filter(user_id=user_id)
+        .values_list("storage_prefix", flat=True)
+        .first()
+    )
+    if prefix is None:
+        prefix = User.objects.get(id=user_id).settings.storage_prefix
+    return prefix
+
+
+get_storage_prefix.cache_clear = _get_storage_prefix.cache_clear
+
+
+User.storage_prefix = property(lambda u: get_storage_prefix(u.id))
+
+
+LIBRARY_VERSION_CACHE_KEY = "song-library-version"
+
+
+def get_library_version():
+    """
+    Counter bumped whenever songs are written, part of the keys of the
+    cached responses listing songs.
+    """
+    version = cache.get(LIBRARY_VERSION_CACHE_KEY)
+    if version is None:
+        # Random start, so that evicting the counter does not bring back
+        # the responses cached under a previous value
+        cache.add(LIBRARY_VERSION_CACHE_KEY, randint(0, 2**31), None)
+        version = cache.get(LIBRARY_VERSION_CACHE_KEY)
+    return version
+
+
+def bump_library_version():
+    def bump():
+        try:
+            cache.incr(LIBRARY_VERSION_CACHE_KEY)
+        except ValueError:
+            get_library_version()
+
+    transaction.on_commit(bump)
+
+
+class MP3SongSequence(models.Model):
+    """
+    Single row holding the number of songs in the library. MP3Song.seq are
+    kept dense in [1, count] so a random song is found with one lookup.
+    The row is locked while songs are added or removed.
+    """
+
+    count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def lock(cls):
+        return cls.objects.select_for_update().get_or_create(pk=1)[0]
+
+    def reserve(self, n):
+        start = self.count + 1
+        self.count += n
+        self.save(update_fields=["count"])
+        return range(start, start + n)
+
+    def release(self, seqs):
+        """
+        Move the songs with the highest numbers into the holes left by the
+        deleted songs numbers, with a single update per batch of holes.
+        """
+        self.count = max(0, self.count - len(seqs))
+        holes = sorted(seq for seq in seqs if seq is not None and seq <= self.count)
+        if holes:
+            movers = MP3Song.objects.filter(seq__gt=self.count).order_by("seq")
+            MP3Song.objects.bulk_update(
+                [
+                    MP3Song(id=song_id, seq=hole)
+                    for hole, song_id in zip(
+                        holes, movers.values_list("id", flat=True)[: len(holes)]
+                    )
+                ],
+                ["seq"],
+                batch_size=1000,
+            )
+        self.save(update_fields=["count"])
+
+
+class MP3SongQuerySet(models.QuerySet):
+    """
+    Keeps MP3Song.search_text and MP3Song.seq up to date for the bulk
+    operations that bypass MP3Song.save and MP3Song.delete.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        With ignore_conflicts, only the songs actually inserted are returned
+        and the numbers reserved for the others are released.
+        """
+        objs = list(objs)
+        for obj in objs:
+            obj.search_text = normalize_search_text(obj.filename)
+        with transaction.atomic(using=self.db):
+            sequence = MP3SongSequence.lock()
+            seqs = sequence.reserve(len(objs))
+            for obj, seq in zip(objs, seqs):
+                obj.seq = seq
+            result = super().bulk_create(objs, *args, **kwargs)
+            if kwargs.get("ignore_conflicts") and objs:
+                created_ids = set(
+                    self.filter(seq__gte=seqs[0], seq__lte=seqs[-1]).values_list(
+                        "id", flat=True
+                    )
+                )
+                result = [obj for obj in objs if obj.id in created_ids]
+                ignored = [obj for obj in objs if obj.id not in created_ids]
+                sequence.release([obj.seq for obj in ignored])
+                for obj in ignored:
+                    obj.seq = None
+            ShuffleDeck.add_songs([obj.id for obj in result])
+            bump_library_version()
+        return result
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            sequence = MP3SongSequence.lock()
+            seqs = list(self.values_list("seq", flat=True))
+            result = super().delete()
+            sequence.release(seqs)
+            bump_library_version()
+        return result
+
+    def update(self, **kwargs):
+        result = super().update(**kwargs)
+        bump_library_version()
+        return result
+
+    def available(self):
+        """
+        Songs whose file is not known to be missing. The songs reserved by
+        an upload are only available once their file is stored.
+        """
+        return self.exclude(mp3_available=False)
+
+    def pick_random(self):
+        """
+        Uniformly pick a song with an indexed lookup on a random seq, falls
+        back to an OFFSET on the rare occasions the seq is not in this
+        queryset (holes left by cascading deletes or a filtered queryset).
+        """
+        count = MP3SongSequence.objects.values_list("count", flat=True).first()
+        for _ in range(3 if count else 0):
+            song = self.filter(seq=randint(1, count)).first()
+            if song is not None:
+                return song
+        count = self.count()
+        if count == 0:
+            return None
+        return self[randint(0, count - 1)]
+
+    def sample_ids(self, n):
+        """
+        Ids of up to n distinct songs picked uniformly in one indexed lookup
+        on random seqs, fewer are returned when some seqs are holes or not in
+        this queryset.
+        """
+        count = MP3SongSequence.objects.values_list("count", flat=True).first() or 0
+        seqs = sample(range(1, count + 1), min(n, count))
+        song_ids = list(self.filter(seq__in=seqs).values_list("id", flat=True))
+        shuffle(song_ids)
+        return song_ids
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        fields = list(fields)
+        if "filename" in fields:
+            objs = list(objs)
+            for obj in objs:
+                obj.search_text = normalize_search_text(obj.filename)
+            if "search_text" not in fields:
+                fields.append("search_text")
+        result = super().bulk_update(objs, fields, *args, **kwargs)
+        bump_library_version()
+        return result
+
+    def search(self, text, ranked=True):
+        """
+        Songs whose filename contains every term of the text, terms within
+        double quotes are matched as a whole. On postgres the lookups are
+        served by the pg_trgm index and results are ranked by relevance
+        unless ranked is False.
+        """
+        quoted_terms = re.findall(r"\"(.+?)\"", text)
+        if quoted_terms:
+            text = re.sub(r"\"(.+?)\"", "", text)
+        terms = [normalize_search_text(term) for term in text.split(" ") + quoted_terms]
+        terms = [term for term in terms if term]
+        if not terms:
+            return self.none()
+        query = Q()
+        for term in terms:
+            query &= Q(search_text__contains=term)
+        qs = self.filter(query)
+        if not ranked or connections[qs.db].vendor != "postgresql":
+            return qs.order_by("filename")
+        search_query = " ".join(terms)
+        rank = SearchRank(
+            SearchVector("search_text", config="simple"),
+            SearchQuery(search_query, config="simple"),
+        ) + TrigramWordSimilarity(search_query, "search_text")
+        return qs.annotate(rank=rank).order_by("-rank", "filename")
+
+
 class MP3Song(models.Model):
     id = models.CharField(default=random_key, max_length=12, primary_key=True)
     filename = models.CharField(
         verbose_name="file name",
         max_length=255,
     )
+    search_text = models.TextField(default="", editable=False)
+    seq = models.PositiveIntegerField(null=True, unique=True, editable=False)
     duration = models.IntegerField(default=0)
+    mp3_available = models.BooleanField(null=True)
+    size = models.BigIntegerField(null=True)
+    etag = models.CharField(max_length=64, blank=True, default="")
+    # Content hash of the file, see nickelodeon.utils.content_hash
+    content_hash = models.CharField(max_length=64, blank=True, default="")
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
+    objects = MP3SongQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.search_text = normalize_search_text(self.filename)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "filename" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "search_text"}
+        bump_library_version()
+        if not (self._state.adding and self.seq is None):
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            (self.seq,) = MP3SongSequence.lock().reserve(1)
+            super().save(*args, **kwargs)
+            ShuffleDeck.add_songs([self.id])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            sequence = MP3SongSequence.lock()
+            seqs = list(
+                MP3Song.objects.filter(id=self.id).values_list("seq", flat=True)
+            )
+            result = super().delete(*args, **kwargs)
+            sequence.release(seqs)
+            bump_library_version()
+        return result
+
     def has_extension(self, extension):
         file_path = self.get_file_format_path(extension).encode("utf-8")
         return s3_object_exists(file_path)
 
     @property
     def has_mp3(self):
-        return self.has_extension("mp3")
+        if self.mp3_available is None:
+            # Songs added before the file metadata was stored in the database
+            self.set_file_metadata(s3_object_metadata(self.get_file_format_path("mp3")))
+            if not self._state.adding:
+                MP3Song.objects.filter(pk=self.pk).update(
+                    mp3_available=self.mp3_available, size=self.size, etag=self.etag
+                )
+        return self.mp3_available
+
+    def set_file_metadata(self, metadata):
+        self.mp3_available = metadata is not None
+        self.size = metadata and metadata["size"]
+        self.etag = metadata and metadata["etag"] or ""
 
     def get_absolute_url(self):
         return reverse("song_detail", kwargs={"pk": self.pk})
@@ -63,6 +352,10 @@ class MP3Song(models.Model):
     def get_download_url(self):
         return reverse("song_download", kwargs={"pk": self.pk})
 
+    @property
+    def storage_prefix(self):
+        return get_storage_prefix(self.owner_id)
+
     @property
     def owner_username(self):
         return self.owner.username
@@ -77,49 +370,32 @@ class MP3Song(models.Model):
         return {"mp3": self.has_mp3}
 
     def get_file_format_path(self, extension="mp3"):
-        file_path = "{}/{}.{}".format(
-            self.owner.settings.storage_prefix, self.filename, extension
-        )
+        file_path = "{}/{}.{}".format(self.storage_prefix, self.filename, extension)
         return os.path.normpath(file_path)
 
-    def can_move_to_dest(self, dest):
-        new_instance = MP3Song(filename=dest, owner=self.owner)
-        for ext, available in self.available_formats.items():
-            if available:
-                dst = new_instance.get_file_format_path(extension=ext)
-                if s3_object_exists(dst):
-                    return False
-        return True
-
-    def move_file_to(self, dest_filename):
-        for ext, available in self.available_formats.items():
-            if available:
-                src = self.get_file_format_path(extension=ext)
-                dst = os.path.normpath(
-                    f"{self.owner.settings.storage_prefix}/{dest_filename}.{ext}"
-                )
-                s3_move_object(src, dst)
-        self.filename = dest_filename
-
     def remove_files(self):
         ext = "mp3"
         file_path = self.get_file_format_path(ext).encode("utf-8")
-        if s3_object_exists(file_path):
+        if self.has_mp3:
             s3_object_delete(file_path)
+        self.set_file_metadata(None)
+
+    def probe_duration(self):
+        """
+        Duration of the file in seconds read from its headers, along with
+        the number of bytes downloaded to find it.
+        """
+        extension = "mp3"
+        file = S3RangeReader(self.get_file_format_path(extension))
+        return get_mp3_duration(file), file.bytes_transferred
 
     def get_duration(self, invalidate_cache=False):
         if self.duration and not invalidate_cache:
             return self.duration
-        extension = "mp3"
-        file = s3_get_file(self.get_file_format_path(extension))
-        audio = None
-        try:
-            audio = mutagen.File(fileobj=BytesIO(file.getvalue()))
-        except Exception:
-            pass
-        if not audio:
+        duration, _ = self.probe_duration()
+        if not duration:
             return 0
-        self.duration = round(audio.info.length)
+        self.duration = duration
         self.save()
         return self.duration
 
@@ -130,3 +406,322 @@ class MP3Song(models.Model):
                 name="unique_owner_filename",
             ),
         ]
+        indexes = [models.Index(fields=["owner", "content_hash"])]
+
+
+@receiver(pre_delete, sender=User)
+def delete_user_songs(sender, instance, **kwargs):
+    """
+    Songs deleted along with their owner would otherwise be cascaded by the
+    collector, leaving their seqs as holes.
+    """
+    MP3Song.objects.filter(owner=instance).delete()
+
+
+class ShuffleDeck(models.Model):
+    """
+    Per user random permutation of the library, cards are sorted by a
+    random key and dealt in that order from the cursor on, so that no song
+    is dealt twice before the whole deck has been.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, related_name="shuffle_deck"
+    )
+    cursor = models.FloatField(default=0)
+    # New decks are dealt their cards by the process_uploads worker
+    built = models.BooleanField(default=False)
+
+    @classmethod
+    def build_pending(cls):
+        """
+        Build the decks not built yet, returns their number. Locked decks
+        are skipped so several builders can run at once.
+        """
+        count = 0
+        while True:
+            with transaction.atomic():
+                deck = (
+                    cls.objects.select_for_update(skip_locked=True)
+                    .filter(built=False)
+                    .first()
+                )
+                if deck is None:
+                    return count
+                deck.build()
+            count += 1
+
+    def build(self):
+        """
+        Deal a card to the deck for every song it lacks, in a single
+        INSERT ... SELECT.
+        """
+        connection = connections[self._state.db or "default"]
+        rand = "random()" if connection.vendor == "postgresql" else "RAND()"
+        card_table = ShuffleDeckCard._meta.db_table
+        song_table = MP3Song._meta.db_table
+        key = connection.ops.quote_name("key")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {card_table} (deck_id, song_id, {key}) "
+                f"SELECT %s, s.id, {rand} FROM {song_table} s WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {card_table} c "
+                "WHERE c.deck_id = %s AND c.song_id = s.id)",
+                [self.id, self.id],
+            )
+        self.cursor = 0
+        self.built = True
+        self.save(update_fields=["cursor", "built"])
+
+    def shuffle(self):
+        """
+        Reshuffle the cards in place, with a single UPDATE.
+        """
+        self.cards.update(key=Random())
+        self.cursor = 0
+
+    def draw(self, n):
+        cards = self.cards.filter(key__gt=self.cursor).order_by("key")
+        return list(cards.values_list("key", "song_id")[:n])
+
+    def deal(self, n):
+        """
+        Return the ids of the next n songs of the deck, the deck is
+        reshuffled when it runs out of cards.
+        """
+        cards = self.draw(n)
+        song_ids = [song_id for _, song_id in cards]
+        if len(cards) < n:
+            # Deal the rest of the hand from a new deck, without the songs
+            # already in the hand. Those of them that the new cursor skips
+            # are put back in play.
+            self.shuffle()
+            cards = [card for card in self.draw(n) if card[1] not in song_ids]
+            cards = cards[: n - len(song_ids)]
+            if cards:
+                skipped = self.cards.filter(song_id__in=song_ids, key__lte=cards[-1][0])
+                for card in skipped:
+                    card.key = uniform(cards[-1][0], 1)
+                    card.save(update_fields=["key"])
+            song_ids += [song_id for _, song_id in cards]
+        if cards:
+            self.cursor = cards[-1][0]
+        self.save(update_fields=["cursor"])
+        return song_ids
+
+    @classmethod
+    def add_songs(cls, song_ids):
+        """
+        Insert the songs at random positions among the cards not dealt yet.
+        """
+        cards = []
+        for deck_id, cursor in cls.objects.values_list("id", "cursor"):
+            cards += [
+                ShuffleDeckCard(
+                    deck_id=deck_id, song_id=song_id, key=uniform(cursor, 1)
+                )
+                for song_id in song_ids
+            ]
+        ShuffleDeckCard.objects.bulk_create(cards, batch_size=2000)
+
+
+class ShuffleDeckCard(models.Model):
+    deck = models.ForeignKey(
+        ShuffleDeck, on_delete=models.CASCADE, related_name="cards"
+    )
+    song = models.ForeignKey(MP3Song, on_delete=models.CASCADE)
+    key = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=["deck", "key"])]
+
+
+class UploadSession(models.Model):
+    """
+    S3 multipart upload receiving the chunks of a resumable upload, parts
+    maps the part numbers already uploaded to their ETag and the digests of
+    their blocks, see content_hash.
+    """
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    identifier = models.CharField(max_length=255)
+    key = models.CharField(max_length=1024)
+    upload_id = models.CharField(max_length=1024, blank=True, default="")
+    parts = models.JSONField(default=dict)
+    creation_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner", "identifier"],
+                name="unique_owner_upload_identifier",
+            ),
+        ]
+
+    @property
+    def etags(self):
+        return {number: part["etag"] for number, part in self.parts.items()}
+
+    def content_hash(self):
+        """
+        Content hash of the uploaded file from the digests of its parts,
+        None when the parts are not made of whole blocks.
+        """
+        digests = []
+        for _, part in sorted(self.parts.items(), key=lambda p: int(p[0])):
+            if part["digests"] is None:
+                return None
+            digests += part["digests"]
+        return content_hash(digests)
+
+
+class UploadJob(models.Model):
+    """
+    Finalization of a complete upload, processed out of the request by the
+    process_uploads command.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    session = models.ForeignKey(
+        UploadSession, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    song = models.ForeignKey(MP3Song, null=True, blank=True, on_delete=models.SET_NULL)
+    duplicate = models.BooleanField(default=False)
+    error = models.TextField(blank=True, default="")
+    creation_date = models.DateTimeField(auto_now_add=True)
+    modification_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # A complete upload is finalized once, even when its last
+            # chunks are received at the same time by several workers
+            models.UniqueConstraint(
+                fields=["owner", "filename", "total_size"],
+                condition=Q(status__in=["pending", "running"]),
+                name="unique_active_upload_job",
+            ),
+        ]
+        indexes = [models.Index(fields=["status", "creation_date"])]
+
+    @property
+    def identifier(self):
+        # Name of the file assembled by resumable from the chunks
+        return f"{self.total_size}_{self.filename}"
+
+    @classmethod
+    def claim(cls, timeout):
+        """
+        Mark the oldest pending job as running and return it. Jobs left
+        running for more than timeout seconds by a dead worker are claimed
+        again. Locked rows are skipped so several workers can run at once.
+        """
+        stale = timezone.now() - datetime.timedelta(seconds=timeout)
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(status=cls.PENDING)
+                    | Q(status=cls.RUNNING, modification_date__lt=stale)
+                )
+                .order_by("creation_date")
+                .first()
+            )
+            if job is not None:
+                job.status = cls.RUNNING
+                job.save(update_fields=["status", "modification_date"])
+        return job
+
+
+class ScanManifest(models.Model):
+    """
+    Number of MP3 files and most recent modification date found under a
+    prefix of the bucket by the last refresh_song_db run. When not
+    recursive, only the files directly under the prefix are counted.
+    """
+
+    prefix = models.CharField(max_length=1024)
+    recursive = models.BooleanField(default=True)
+    object_count = models.PositiveIntegerField(default=0)
+    last_modified = models.DateTimeField(null=True, blank=True)
+    scan_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["prefix", "recursive"],
+                name="unique_scan_manifest_prefix",
+            ),
+        ]
+
+
+class BackfillCheckpoint(models.Model):
+    """
+    Id of the last song processed by a backfill, so that an interrupted
+    run resumes after it.
+    """
+
+    name = models.CharField(max_length=64, unique=True)
+    last_id = models.CharField(max_length=12, blank=True, default="")
+    modification_date = models.DateTimeField(auto_now=True)
+
+
+class SongMove(models.Model):
+    """
+    Journal of a song file being moved by tasks.move_songs, written along
+    with the new filename of the song. An entry left by a crash or a failed
+    copy is rolled forward by tasks.roll_forward_moves. copied is set once
+    the file is at dst_key, only the deletion of the source file remains.
+    modification_date is the lease of the process applying the move.
+    """
+
+    song = models.ForeignKey(MP3Song, on_delete=models.CASCADE)
+    src_key = models.CharField(max_length=1024)
+    dst_key = models.CharField(max_length=1024)
+    filename = models.CharField(max_length=255)
+    copied = models.BooleanField(default=False)
+    error = models.TextField(blank=True, default="")
+    creation_date = models.DateTimeField(auto_now_add=True)
+    modification_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["modification_date"])]
+
+    @classmethod
+    def claim(cls, timeout, limit=1000):
+        """
+        Renew the lease of up to limit entries not touched for timeout
+        seconds and return them. Locked rows are skipped so that several
+        processes rolling moves forward do not apply the same ones.
+        """
+        stale = timezone.now() - datetime.timedelta(seconds=timeout)
+        with transaction.atomic():
+            entries = list(
+                cls.objects.select_for_update(skip_locked=True, of=("self",))
+                .select_related("song")
+                .filter(modification_date__lt=stale)
+                .order_by("id")[:limit]
+            )
+            cls.objects.filter(id__in=[entry.id for entry in entries]).update(
+                modification_date=timezone.now()
+            )
+        return entries
+
+    @classmethod
+    def renew(cls, entries):
+        cls.objects.filter(id__in=[entry.id for entry in entries]).update(
+            modification_date=timezone.now()
+        )
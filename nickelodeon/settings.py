@@ -23,6 +23,14 @@ S3_ENDPOINT_URL = env.str("S3_ENDPOINT_URL")
 S3_BUCKET = env.str("S3_BUCKET")
 S3_ACCESS_KEY = env.str("S3_ACCESS_KEY")
 S3_SECRET_KEY = env.str("S3_SECRET_KEY")
+S3_MAX_POOL_CONNECTIONS = env.int("S3_MAX_POOL_CONNECTIONS", 10)
+S3_TCP_KEEPALIVE = env.bool("S3_TCP_KEEPALIVE", True)
+S3_METADATA_CACHE_TIMEOUT = env.int("S3_METADATA_CACHE_TIMEOUT", 300)
+S3_MULTIPART_UPLOADS = env.bool("S3_MULTIPART_UPLOADS", True)
+S3_MULTIPART_PART_SIZE = env.int("S3_MULTIPART_PART_SIZE", 5 * 1024 * 1024)
+UPLOAD_MAX_SIZE = env.int("UPLOAD_MAX_SIZE", 1024 * 1024 * 1024)
+SONG_SEARCH_CACHE_TIMEOUT = env.int("SONG_SEARCH_CACHE_TIMEOUT", 60)
+STORAGE_PREFIX_CACHE_TIMEOUT = env.int("STORAGE_PREFIX_CACHE_TIMEOUT", 60)
 
 SESSION_COOKIE_DOMAIN = env.str("SESSION_COOKIE_DOMAIN")
 SESSION_COOKIE_HTTPONLY = env.bool("SESSION_COOKIE_HTTPONLY")
@@ -32,6 +40,14 @@ CSRF_COOKIE_SECURE = env.bool("CSRF_COOKIE_SECURE")
 SENTRY_DSN = env.str("SENTRY_DSN", "")
 
 DATABASES = {"default": env.db()}
+# Shared by the web and upload workers, cached entries are invalidated on
+# writes from any process. The table of the database backend is created by
+# the createcachetable command.
+CACHES = {
+    "default": env.cache(
+        "CACHE_URL", default="dbcache://nickelodeon_cache?max_entries=100000"
+    )
+}
 
 DEBUG = False
 
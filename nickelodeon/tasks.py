@@ -1,55 +1,355 @@
+import datetime
 import os
 import os.path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-from nickelodeon.models import MP3Song
+import botocore
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from resumable.files import ResumableFile
+
+from nickelodeon.models import MP3Song, SongMove
 from nickelodeon.utils import (
-    AVAILABLE_FORMATS,
-    s3_object_exists,
+    S3RangeReader,
+    file_content_hash,
+    get_mp3_duration,
+    s3_complete_multipart_upload,
+    s3_copy_object,
+    s3_delete_objects,
+    s3_list_keys,
+    s3_metadata_cache_key,
+    s3_move_object,
+    s3_object_content_hash,
+    s3_object_delete,
     s3_upload,
 )
 
 
-def move_file(instance_id, from_filename, to_filename):
-    song = None
+class FilenameConflict(Exception):
+    def __init__(self, filenames):
+        super().__init__("Filename already used: {}".format(", ".join(filenames)))
+        self.filenames = filenames
+
+
+def move_songs(moves, workers=8, batch_size=1000):
+    """
+    Renames songs, moves is a list of (song, new_filename) pairs. The songs
+    are saved with their new filenames in one transaction with the journal
+    of the moves, so that the unique constraint holds the new names before
+    any file is written. The files are then copied by a pool of threads
+    and the old files deleted, batch_size moves at a time, the leases of
+    the moves still waiting being renewed after every batch. A move whose
+    copy fails is left in the journal for roll_forward_moves.
+    """
+    moves = [(song, filename) for song, filename in moves if filename != song.filename]
+    if not moves:
+        return []
+    conflicts = find_conflicts(moves)
+    if conflicts:
+        raise FilenameConflict(conflicts)
+    entries = [
+        SongMove(
+            song=song,
+            src_key=song.get_file_format_path(),
+            dst_key=MP3Song(
+                filename=filename, owner_id=song.owner_id
+            ).get_file_format_path(),
+            filename=filename,
+        )
+        for song, filename in moves
+    ]
+    old_filenames = [song.filename for song, _ in moves]
+    try:
+        with transaction.atomic():
+            for song, filename in moves:
+                song.filename = filename
+            MP3Song.objects.bulk_update(
+                [song for song, _ in moves], ["filename"], batch_size=batch_size
+            )
+            entries = SongMove.objects.bulk_create(entries, batch_size=batch_size)
+    except IntegrityError:
+        # A name was taken since it was checked
+        for (song, _), filename in zip(moves, old_filenames):
+            song.filename = filename
+        raise FilenameConflict(find_conflicts(moves))
+    for start in range(0, len(entries), batch_size):
+        apply_moves(entries[start : start + batch_size], workers)
+        SongMove.renew(entries[start + batch_size :])
+    return [song for song, _ in moves]
+
+
+def find_conflicts(moves):
+    """
+    New filenames of moves used by another song, or by several moves.
+    """
+    filenames = {}
+    conflicts = set()
+    for song, filename in moves:
+        owner_filenames = filenames.setdefault(song.owner_id, set())
+        if filename in owner_filenames:
+            conflicts.add(filename)
+        owner_filenames.add(filename)
+    query = Q()
+    for owner_id, owner_filenames in filenames.items():
+        query |= Q(owner_id=owner_id, filename__in=owner_filenames)
+    conflicts.update(MP3Song.objects.filter(query).values_list("filename", flat=True))
+    return sorted(conflicts)
+
+
+def move_folder(owner, src_folder, dst_folder, workers=8):
+    """
+    Moves the songs of owner whose filename starts with src_folder.
+    """
+    songs = MP3Song.objects.filter(owner=owner, filename__startswith=src_folder)
+    return move_songs(
+        [(song, dst_folder + song.filename[len(src_folder) :]) for song in songs],
+        workers,
+    )
+
+
+def roll_forward_moves(older_than=600, workers=8):
+    """
+    Completes the moves whose lease expired more than older_than seconds
+    ago, interrupted by a crash or a failed copy. Returns the songs moved.
+    """
+    songs = []
+    while entries := SongMove.claim(older_than):
+        songs += [entry.song for entry in apply_moves(entries, workers)]
+    return songs
+
+
+@lru_cache(maxsize=None)
+def get_copy_executor(workers):
+    """
+    Pool of threads copying the files of moves, shared by the calls of the
+    process.
+    """
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def apply_moves(entries, workers=8):
+    """
+    Copies the files of the moves not copied yet, then deletes the source
+    files and the journal entries. Entries whose copy or deletion fails
+    are kept with their error. Returns the entries applied.
+    """
+    pending = [entry for entry in entries if not entry.copied]
+    if len(pending) > 1:
+        results = list(get_copy_executor(workers).map(safe_copy_song_file, pending))
+    else:
+        results = [safe_copy_song_file(entry) for entry in pending]
+    failed = []
+    songs = []
+    for entry, (etag, error) in zip(pending, results):
+        if error is not None:
+            entry.error = error
+            failed.append(entry)
+            continue
+        entry.copied = True
+        if etag is not None:
+            entry.song.etag = etag
+            songs.append(entry.song)
+    copied = [entry for entry in entries if entry.copied]
+    cache.delete_many([s3_metadata_cache_key(entry.dst_key) for entry in copied])
+    with transaction.atomic():
+        MP3Song.objects.bulk_update(songs, ["etag"])
+        SongMove.objects.filter(id__in=[entry.id for entry in copied]).update(
+            copied=True
+        )
+    errors = s3_delete_objects(
+        [entry.src_key for entry in copied if entry.src_key != entry.dst_key]
+    )
+    done = []
+    for entry in copied:
+        if entry.src_key in errors:
+            entry.error = errors[entry.src_key]
+            failed.append(entry)
+        else:
+            done.append(entry)
+    SongMove.objects.bulk_update(failed, ["error"])
+    SongMove.objects.filter(id__in=[entry.id for entry in done]).delete()
+    return done
+
+
+def safe_copy_song_file(entry):
+    """
+    ETag of the copied file, or the error of the copy.
+    """
     try:
-        song = MP3Song.objects.get(id=instance_id)
-    except MP3Song.DoesNotExist:
-        return
-    song.filename = from_filename
+        return copy_song_file(entry), None
+    except Exception as e:
+        return None, str(e)
+
+
+def copy_song_file(entry):
+    if entry.song.mp3_available is False or entry.src_key == entry.dst_key:
+        return None
     try:
-        song.move_file_to(to_filename)
-    except Exception:
-        return
-    finally:
-        song.save()
-    return
+        return s3_copy_object(entry.src_key, entry.dst_key, invalidate_cache=False)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            # Already moved before a crash, or never uploaded
+            return None
+        raise
 
 
-def move_files_to_destination(dst_folder, safe_title, extensions, tmp_paths):
-    filename = safe_title
+def delete_songs(songs):
+    """
+    Deletes songs and their files, with one DeleteObjects request per 1000
+    files and one query for the rows. Returns the deleted songs and the
+    (song, error) pairs of the songs whose file could not be deleted.
+    """
+    keys = {
+        song.get_file_format_path(): song
+        for song in songs
+        if song.mp3_available is not False
+    }
+    errors = s3_delete_objects(keys)
+    failed = [(keys[key], error) for key, error in errors.items()]
+    failed_ids = {song.id for song, _ in failed}
+    deleted = [song for song in songs if song.id not in failed_ids]
+    MP3Song.objects.filter(id__in=[song.id for song in deleted]).delete()
+    return deleted, failed
+
+
+def get_taken_filenames(owner, dst_folder, safe_title):
+    """
+    Paths, without extension, of the files of the library of owner that
+    could collide with safe_title in dst_folder. Looked up at once in the
+    database and in the bucket, for files not yet known to the database.
+    """
+    root_folder = owner.storage_prefix
+    prefix = os.path.join(dst_folder, safe_title)
+    filenames = MP3Song.objects.filter(
+        owner=owner, filename__startswith=prefix[len(root_folder) + 1 :]
+    ).values_list("filename", flat=True)
+    taken = {os.path.join(root_folder, filename) for filename in filenames}
+    taken.update(os.path.splitext(key)[0] for key in s3_list_keys(prefix))
+    return taken
+
+
+def get_available_filename(dst_folder, safe_title, taken):
     attempt = 0
-    while True:
-        file_exist = False
-        for ext, lib in AVAILABLE_FORMATS.items():
-            if attempt == 0:
-                filename = "{}.{}".format(safe_title, ext)
-            else:
-                filename = "{} ({}).{}".format(safe_title, attempt, ext)
-            final_path = os.path.join(dst_folder, filename)
-            if ext in extensions and s3_object_exists(final_path):
-                file_exist = True
-                break
-        if not file_exist:
-            break
+    filename = safe_title
+    while os.path.join(dst_folder, filename) in taken:
         attempt += 1
-    for ext, lib in AVAILABLE_FORMATS.items():
-        if ext in extensions:
-            if attempt == 0:
-                filename = safe_title
-            else:
-                filename = "{} ({})".format(safe_title, attempt)
-            final_path = os.path.join(dst_folder, filename + "." + ext)
-            with open(tmp_paths[ext], mode="rb") as f:
-                s3_upload(f, final_path)
-            os.remove(tmp_paths[ext])
+        filename = "{} ({})".format(safe_title, attempt)
     return filename
+
+
+def reserve_song(owner, dst_folder, safe_title, **fields):
+    """
+    Create the song of a file about to be stored in dst_folder, under the
+    first free name derived from safe_title. The unique constraint on the
+    owner and filename makes the reservation atomic, a name reserved by a
+    concurrent upload is skipped.
+    """
+    root_folder = owner.storage_prefix
+    taken = get_taken_filenames(owner, dst_folder, safe_title)
+    while True:
+        path = os.path.join(
+            dst_folder, get_available_filename(dst_folder, safe_title, taken)
+        )
+        try:
+            with transaction.atomic():
+                return MP3Song.objects.create(
+                    filename=path[len(root_folder) + 1 :],
+                    owner=owner,
+                    mp3_available=False,
+                    **fields,
+                )
+        except IntegrityError:
+            taken.add(path)
+
+
+def store_song(owner, dst_folder, safe_title, store, **fields):
+    """
+    Reserve the song then store its file with store, a callable receiving
+    the destination key and returning the ETag of the stored object.
+    """
+    song = reserve_song(owner, dst_folder, safe_title, **fields)
+    try:
+        etag = store(song.get_file_format_path("mp3"))
+    except Exception:
+        song.delete()
+        raise
+    song.mp3_available = True
+    song.etag = etag or ""
+    song.save(update_fields=["mp3_available", "etag"])
+    return song
+
+
+def upload_file(path, key):
+    with open(path, mode="rb") as f:
+        etag = s3_upload(f, key)
+    os.remove(path)
+    return etag
+
+
+def finalize_upload(job, chunks_dir):
+    """
+    Store the file of a complete upload in the library of its owner and
+    create its song. A file the owner already has is not stored twice, the
+    existing song is returned and the job marked as duplicate.
+    """
+    root_folder = job.owner.storage_prefix
+    now = datetime.datetime.now()
+    dest = os.path.join(root_folder, "Assorted", "by_date", now.strftime("%Y/%m"))
+    title = job.filename[:-4]
+    session = job.session
+    if session is not None:
+        s3_complete_multipart_upload(session.key, session.upload_id, session.etags)
+        content_hash = session.content_hash() or s3_object_content_hash(session.key)
+        existing_song = find_song_by_content_hash(job.owner, content_hash)
+        if existing_song is not None:
+            s3_object_delete(session.key)
+        else:
+            song = store_song(
+                job.owner,
+                dest,
+                title,
+                lambda key: s3_move_object(session.key, key),
+                size=job.total_size,
+                duration=get_mp3_duration(S3RangeReader(session.key)),
+                content_hash=content_hash,
+            )
+        session.delete()
+        job.session = None
+    else:
+        storage = FileSystemStorage(location=chunks_dir)
+        rfile = ResumableFile(
+            storage,
+            {"resumableFilename": job.filename, "resumableTotalSize": job.total_size},
+        )
+        if not storage.exists(rfile.filename):
+            storage.save(rfile.filename, rfile)
+        mp3_path = storage.path(rfile.filename)
+        with open(mp3_path, mode="rb") as f:
+            content_hash = file_content_hash(f)
+            f.seek(0)
+            duration = get_mp3_duration(f)
+        existing_song = find_song_by_content_hash(job.owner, content_hash)
+        if existing_song is not None:
+            storage.delete(rfile.filename)
+        else:
+            song = store_song(
+                job.owner,
+                dest,
+                title,
+                lambda key: upload_file(mp3_path, key),
+                size=job.total_size,
+                duration=duration,
+                content_hash=content_hash,
+            )
+        rfile.delete_chunks()
+    if existing_song is not None:
+        job.duplicate = True
+        return existing_song
+    return song
+
+
+def find_song_by_content_hash(owner, content_hash):
+    return MP3Song.objects.filter(owner=owner, content_hash=content_hash).first()
@@ -1,28 +1,64 @@
+import argparse
 import base64
+import datetime
+import hashlib
+import hmac
+import io
 import os
 import secrets
 import struct
+import threading
+import unicodedata
+import zlib
+from collections import Counter
+from functools import lru_cache
 from io import BytesIO
+from urllib.parse import quote, urlsplit
 
 import boto3
 import botocore
+import mutagen
 from django.conf import settings
+from django.core.cache import cache
 
 AVAILABLE_FORMATS = {"mp3": "libmp3lame"}
 
 
-def get_s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=settings.S3_ENDPOINT_URL,
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-        config=botocore.client.Config(
-            signature_version="s3v4", request_checksum_calculation="when_required"
-        ),
+_s3_lock = threading.Lock()
+_s3_client = None
+_s3_local = threading.local()
+
+
+def get_s3_config(**kwargs):
+    return botocore.client.Config(
+        max_pool_connections=getattr(settings, "S3_MAX_POOL_CONNECTIONS", 10),
+        tcp_keepalive=getattr(settings, "S3_TCP_KEEPALIVE", True),
+        **kwargs,
     )
 
 
+def get_s3_client():
+    """
+    Client shared by the whole process, boto3 clients are thread safe so
+    their connection pool is reused by every call.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                _s3_client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=settings.S3_ENDPOINT_URL,
+                    aws_access_key_id=settings.S3_ACCESS_KEY,
+                    aws_secret_access_key=settings.S3_SECRET_KEY,
+                    config=get_s3_config(
+                        signature_version="s3v4",
+                        request_checksum_calculation="when_required",
+                    ),
+                )
+    return _s3_client
+
+
 def bytes_to_str(b):
     if isinstance(b, str):
         return b
@@ -30,12 +66,124 @@ def bytes_to_str(b):
 
 
 def get_s3_resource():
-    return boto3.resource(
-        "s3",
-        endpoint_url=settings.S3_ENDPOINT_URL,
-        aws_access_key_id=settings.S3_ACCESS_KEY,
-        aws_secret_access_key=settings.S3_SECRET_KEY,
-    )
+    """
+    Resources are not thread safe, each thread gets its own.
+    """
+    resource = getattr(_s3_local, "resource", None)
+    if resource is None:
+        resource = _s3_local.resource = boto3.session.Session().resource(
+            "s3",
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            aws_access_key_id=settings.S3_ACCESS_KEY,
+            aws_secret_access_key=settings.S3_SECRET_KEY,
+            config=get_s3_config(),
+        )
+    return resource
+
+
+@lru_cache(maxsize=16)
+def get_sigv4_signing_key(secret_key, date_stamp, region, service):
+    key = f"AWS4{secret_key}".encode("utf-8")
+    for part in (date_stamp, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    return key
+
+
+class S3Presigner:
+    """
+    Signs GET and HEAD object urls with SigV4 query parameters, the same urls
+    as boto3 generate_presigned_url builds for path style addressing, without
+    going through the botocore request machinery.
+    """
+
+    algorithm = "AWS4-HMAC-SHA256"
+    service = "s3"
+
+    def __init__(
+        self, endpoint_url, bucket, access_key, secret_key, region, expires=3600
+    ):
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.expires = expires
+
+    def url(self, method, key, now=None):
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date_stamp = amz_date[:8]
+        scope = f"{date_stamp}/{self.region}/{self.service}/aws4_request"
+        path = "/{}/{}".format(
+            quote(self.bucket, safe="/~"), quote(bytes_to_str(key), safe="/~")
+        )
+        query = "&".join(
+            f"{name}={quote(value, safe='-_.~')}"
+            for name, value in (
+                ("X-Amz-Algorithm", self.algorithm),
+                ("X-Amz-Credential", f"{self.access_key}/{scope}"),
+                ("X-Amz-Date", amz_date),
+                ("X-Amz-Expires", str(self.expires)),
+                ("X-Amz-SignedHeaders", "host"),
+            )
+        )
+        canonical_request = "\n".join(
+            (
+                method.upper(),
+                path,
+                query,
+                f"host:{self.host}\n",
+                "host",
+                "UNSIGNED-PAYLOAD",
+            )
+        )
+        string_to_sign = "\n".join(
+            (
+                self.algorithm,
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            )
+        )
+        signing_key = get_sigv4_signing_key(
+            self.secret_key, date_stamp, self.region, self.service
+        )
+        signature = hmac.new(
+            signing_key, string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+        return f"{self.endpoint_url}{path}?{query}&X-Amz-Signature={signature}"
+
+
+_s3_presigner = None
+
+
+def get_s3_presigner():
+    global _s3_presigner
+    if _s3_presigner is None:
+        _s3_presigner = S3Presigner(
+            settings.S3_ENDPOINT_URL,
+            settings.S3_BUCKET,
+            settings.S3_ACCESS_KEY,
+            settings.S3_SECRET_KEY,
+            get_s3_client().meta.region_name,
+        )
+    return _s3_presigner
+
+
+def reset_s3_connections():
+    """
+    Forget the S3 client and resources, a forked process (gunicorn workers
+    with preload_app) must not share the connection pool of its parent.
+    """
+    global _s3_lock, _s3_client, _s3_local, _s3_presigner
+    _s3_lock = threading.Lock()
+    _s3_client = None
+    _s3_local = threading.local()
+    _s3_presigner = None
+
+
+os.register_at_fork(after_in_child=reset_s3_connections)
 
 
 def s3_create_bucket(bucket_name):
@@ -49,47 +197,331 @@ def s3_create_bucket(bucket_name):
         pass
 
 
-def s3_object_exists(key):
+s3_metadata_cache_stats = Counter()
+_s3_metadata_stats_lock = threading.Lock()
+
+
+def s3_metadata_cache_key(key):
+    key = bytes_to_str(key).encode("utf-8")
+    return "s3-metadata:" + hashlib.sha1(key).hexdigest()
+
+
+def s3_metadata_cache_count(stat):
+    with _s3_metadata_stats_lock:
+        s3_metadata_cache_stats[stat] += 1
+
+
+def s3_object_metadata(key):
+    """
+    Size, ETag and last modification date of an object, None if it does not
+    exist. Results, missing objects included, are kept in the Django cache
+    for settings.S3_METADATA_CACHE_TIMEOUT seconds and are invalidated by
+    the helpers below that write to the bucket.
+    """
     key = bytes_to_str(key)
-    s3 = get_s3_resource()
+    cache_key = s3_metadata_cache_key(key)
+    metadata = cache.get(cache_key)
+    if metadata is not None:
+        s3_metadata_cache_count("hits")
+        return metadata or None
+    s3_metadata_cache_count("misses")
     try:
-        s3.Bucket(settings.S3_BUCKET).Object(key).load()
+        head = get_s3_client().head_object(Bucket=settings.S3_BUCKET, Key=key)
     except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            return False
-        else:
+        if e.response["Error"]["Code"] != "404":
             # Something else has gone wrong.
             raise
-    return True
+        metadata = {}
+    else:
+        metadata = {
+            "size": head["ContentLength"],
+            "etag": head["ETag"].strip('"'),
+            "last_modified": head["LastModified"],
+        }
+    cache.set(cache_key, metadata, getattr(settings, "S3_METADATA_CACHE_TIMEOUT", 300))
+    return metadata or None
+
+
+def s3_metadata_cache_set_missing(key):
+    cache.set(
+        s3_metadata_cache_key(key),
+        {},
+        getattr(settings, "S3_METADATA_CACHE_TIMEOUT", 300),
+    )
+
+
+def s3_object_exists(key):
+    return s3_object_metadata(key) is not None
 
 
 def s3_object_delete(key):
     key = bytes_to_str(key)
     s3 = get_s3_resource()
     s3.Bucket(settings.S3_BUCKET).Object(key).delete()
+    s3_metadata_cache_set_missing(key)
 
 
-def s3_move_object(src, dest):
+def s3_copy_object(src, dest, invalidate_cache=True):
+    """
+    Copies src to dest, returns the ETag of the copy. Callers copying from
+    several threads invalidate the cached metadata of dest themselves.
+    """
     src = bytes_to_str(src)
     dest = bytes_to_str(dest)
-    s3 = get_s3_resource()
-    s3.Bucket(settings.S3_BUCKET).Object(dest).copy_from(
-        CopySource=os.path.join(settings.S3_BUCKET, src)
+    s3 = get_s3_client()
+    result = s3.copy_object(
+        Bucket=settings.S3_BUCKET,
+        Key=dest,
+        CopySource={"Bucket": settings.S3_BUCKET, "Key": src},
     )
-    s3.Bucket(settings.S3_BUCKET).Object(src).delete()
+    if invalidate_cache:
+        cache.delete(s3_metadata_cache_key(dest))
+    return result["CopyObjectResult"]["ETag"].strip('"')
+
+
+def s3_move_object(src, dest):
+    etag = s3_copy_object(src, dest)
+    s3_object_delete(src)
+    return etag
+
+
+def s3_delete_objects(keys):
+    """
+    Deletes keys with one DeleteObjects request per 1000 keys, returns a
+    dict of the keys that could not be deleted with their error message.
+    """
+    s3 = get_s3_client()
+    keys = [bytes_to_str(key) for key in keys]
+    errors = {}
+    for start in range(0, len(keys), 1000):
+        batch = keys[start : start + 1000]
+        response = s3.delete_objects(
+            Bucket=settings.S3_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        for error in response.get("Errors", []):
+            errors[error["Key"]] = error.get("Message") or error.get("Code")
+        cache.set_many(
+            {s3_metadata_cache_key(key): {} for key in batch if key not in errors},
+            getattr(settings, "S3_METADATA_CACHE_TIMEOUT", 300),
+        )
+    return errors
+
+
+def s3_list_keys(prefix):
+    """
+    Keys of the bucket starting with prefix, one request per 1000 keys.
+    """
+    s3 = get_s3_client()
+    # Should use v2 but wasabi fails to list all files with it
+    paginator = s3.get_paginator("list_objects")
+    for page in paginator.paginate(Bucket=settings.S3_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
 
 
 def s3_upload(src, key):
+    """
+    Uploads the file object src to key, returns the ETag of the object.
+    """
     s3 = get_s3_client()
     s3.upload_fileobj(src, settings.S3_BUCKET, key)
+    cache.delete(s3_metadata_cache_key(key))
+    # upload_fileobj does not return the response, the HEAD request also
+    # warms the metadata cache
+    return s3_object_metadata(key)["etag"]
 
 
-def s3_object_url(method, key):
+def s3_create_multipart_upload(key):
+    s3 = get_s3_client()
+    return s3.create_multipart_upload(Bucket=settings.S3_BUCKET, Key=key)["UploadId"]
+
+
+def s3_upload_part(key, upload_id, part_number, body):
     s3 = get_s3_client()
-    return s3.generate_presigned_url(
-        ClientMethod=f"{method.lower()}_object",
-        Params={"Bucket": settings.S3_BUCKET, "Key": key},
+    response = s3.upload_part(
+        Bucket=settings.S3_BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body,
     )
+    return response["ETag"]
+
+
+def s3_complete_multipart_upload(key, upload_id, parts):
+    """
+    parts maps the part numbers to the ETags returned by s3_upload_part.
+    """
+    s3 = get_s3_client()
+    s3.complete_multipart_upload(
+        Bucket=settings.S3_BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": int(number), "ETag": etag}
+                for number, etag in sorted(parts.items(), key=lambda p: int(p[0]))
+            ]
+        },
+    )
+    cache.delete(s3_metadata_cache_key(key))
+
+
+def s3_abort_multipart_upload(key, upload_id):
+    s3 = get_s3_client()
+    s3.abort_multipart_upload(Bucket=settings.S3_BUCKET, Key=key, UploadId=upload_id)
+
+
+def s3_object_url(method, key):
+    return get_s3_presigner().url(method, key)
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Read only, seekable file object over an S3 object that only downloads
+    the blocks that are actually read, with ranged GET requests.
+    """
+
+    block_size = 64 * 1024
+
+    def __init__(self, key, block_size=None):
+        super().__init__()
+        self.key = bytes_to_str(key)
+        self.block_size = block_size or self.block_size
+        self.blocks = {}
+        self.position = 0
+        self.bytes_transferred = 0
+        self.size = None
+        # The size of the object is learned from the first response
+        self.get_block(0)
+
+    def get_block(self, index):
+        block = self.blocks.get(index)
+        if block is not None:
+            return block
+        start = index * self.block_size
+        try:
+            response = get_s3_client().get_object(
+                Bucket=settings.S3_BUCKET,
+                Key=self.key,
+                Range=f"bytes={start}-{start + self.block_size - 1}",
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise
+            # Empty object
+            self.size = 0
+            block = b""
+        else:
+            self.size = int(response["ContentRange"].rsplit("/", 1)[1])
+            block = response["Body"].read()
+        self.bytes_transferred += len(block)
+        self.blocks[index] = block
+        return block
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else self.position + size
+        end = min(end, self.size)
+        chunks = []
+        while self.position < end:
+            index, offset = divmod(self.position, self.block_size)
+            block = self.get_block(index)
+            chunk = block[offset : offset + end - self.position]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.position += len(chunk)
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def get_mp3_duration(fileobj):
+    """
+    Duration in seconds of an MP3 read from its headers, 0 if unknown.
+    """
+    audio = None
+    try:
+        audio = mutagen.File(fileobj=fileobj)
+    except Exception:
+        pass
+    # Files without tags are falsy
+    if audio is None:
+        return 0
+    return round(audio.info.length)
+
+
+CONTENT_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def block_digests(data):
+    """
+    SHA-256 digests of the consecutive blocks of CONTENT_HASH_BLOCK_SIZE
+    bytes of data.
+    """
+    return [
+        hashlib.sha256(data[i : i + CONTENT_HASH_BLOCK_SIZE]).hexdigest()
+        for i in range(0, len(data), CONTENT_HASH_BLOCK_SIZE)
+    ]
+
+
+def content_hash(digests):
+    """
+    Key used to deduplicate files, the SHA-256 of the digests of their
+    blocks. It can be computed from the parts of an upload as they are
+    received, without reading the whole file back.
+    """
+    return hashlib.sha256("".join(digests).encode("ascii")).hexdigest()
+
+
+def file_content_hash(fileobj):
+    digests = []
+    block = b""
+    # Streams can return fewer bytes than asked, blocks are filled up
+    while data := fileobj.read(CONTENT_HASH_BLOCK_SIZE - len(block)):
+        block += data
+        if len(block) == CONTENT_HASH_BLOCK_SIZE:
+            digests += block_digests(block)
+            block = b""
+    if block:
+        digests += block_digests(block)
+    return content_hash(digests)
+
+
+def s3_object_content_hash(key):
+    """
+    Content hash of an object, streamed without keeping it in memory.
+    """
+    s3 = get_s3_client()
+    body = s3.get_object(Bucket=settings.S3_BUCKET, Key=bytes_to_str(key))["Body"]
+    with body:
+        return file_content_hash(body)
 
 
 def s3_get_file(key):
@@ -99,6 +531,16 @@ def s3_get_file(key):
     return s3_buffer
 
 
+def normalize_search_text(text):
+    """
+    Lowercase and strip accents so that "Beyoncé" is stored and searched as
+    "beyonce", the same way postgres unaccent + icontains used to match.
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return stripped.casefold()
+
+
 def random_key():
     rand_bytes = bytes(struct.pack("Q", secrets.randbits(64)))
     b64 = base64.b64encode(rand_bytes).decode("utf-8")
@@ -106,3 +548,27 @@ def random_key():
     b64 = b64.replace("+", "-")
     b64 = b64.replace("/", "_")
     return b64
+
+
+def parse_shard(value):
+    """
+    Parses a --shard INDEX/COUNT argument, INDEX from 1 to COUNT.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be INDEX/COUNT, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard INDEX must be between 1 and COUNT")
+    return index, count
+
+
+def in_shard(key, shard):
+    """
+    Whether key, a song id or storage prefix, belongs to shard. Keys are
+    spread by a stable hash so every host agrees on the partition.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(key.encode("utf-8")) % count == index - 1